@@ -4,21 +4,33 @@ from toga.constants import ROW
 from travertino.constants import COLUMN
 
 from stickyhours import utils
+from stickyhours.accountindex import AccountSearch
+
+# Seconds without typing before the filter is applied
+FILTER_DEBOUNCE = 0.15
+
+# Maximum amount of matches shown in the selector, typing more narrows them down
+ENTRY_WINDOW = 50
 
 
 class AccountEntry:
-    def __init__(self, controller, options_func, add_button_translation, filter_placeholder_translation, value=None):
+    def __init__(self, controller, index_func, add_button_translation, filter_placeholder_translation, value=None):
         self.controller = controller
-        self.options_func = options_func
+        self.index_func = index_func
+
+        self.search = AccountSearch(self.index_func())
+        self._filter_handle = None
 
         # Selector with items
-        self.selector = toga.Selection(items=self.options_func(), accessor='name', style=Pack(flex=1))
+        self.selector = toga.Selection(items=self.search.search('', ENTRY_WINDOW), accessor='name', style=Pack(flex=1))
+        self._shown_ids = None
 
 
         # Text input to filter selector
         self.filter_input = toga.TextInput(on_change=self.filter_selector, placeholder=filter_placeholder_translation, style=Pack(flex=1))
         if value:
             self.filter_input.value = value
+            self.apply_filter()
 
         # Remove button
         self.remove_button = toga.Button(add_button_translation, on_press=self.remove_entry, style=utils.button_style)
@@ -30,11 +42,32 @@ class AccountEntry:
         )
 
     def filter_selector(self, widget):
-        filtered_items = [option for option in self.options_func() if widget.value.lower() in option.get('name').lower()]
-        self.selector.items = filtered_items
+        # Debounced, so typing a name filters once instead of on every keystroke
+        if self._filter_handle is not None:
+            self._filter_handle.cancel()
+
+        self._filter_handle = self.controller.loop.call_later(FILTER_DEBOUNCE, self.apply_filter)
+
+    def apply_filter(self):
+        if self._filter_handle is not None:
+            self._filter_handle.cancel()
+            self._filter_handle = None
+
+        # The accounts are reloaded after logging in again
+        index = self.index_func()
+        if index is not self.search.index:
+            self.search = AccountSearch(index)
+
+        filtered_items = self.search.search(self.filter_input.value, ENTRY_WINDOW)
+
+        # Only rebuild the selector items when the matches changed
+        ids = [item['id'] for item in filtered_items]
+        if ids != self._shown_ids:
+            self.selector.items = filtered_items
+            self._shown_ids = ids
 
     def remove_entry(self, widget):
         self.controller.remove_entry(self)
 
     def get_value(self):
-        return self.selector.value
\ No newline at end of file
+        return self.selector.value
@@ -0,0 +1,104 @@
+import heapq
+import unicodedata
+from collections import defaultdict
+
+# Length of the n-grams in the index, shorter queries scan all names
+GRAM = 3
+
+
+def normalize(text: str) -> str:
+    # Case and accent insensitive form of a name or query, with whitespace collapsed
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+
+    return ' '.join(text.casefold().split())
+
+
+class AccountIndex:
+    # Substring search over the names and codes of accounts ({"name", "id", "teacher"} dicts).
+    # Every trigram of a normalized name maps to the sorted positions of the accounts containing it,
+    # so a query only checks the accounts of its rarest trigram.
+
+    def __init__(self, accounts: list[dict]):
+        # Immutable, one index is shared by all entries without copying the accounts
+        self.accounts = tuple(accounts)
+
+        self._codes = [normalize(str(account['id'])) for account in accounts]
+        self._names = [
+            name if code in name else f'{name} {code}'
+            for name, code in zip((normalize(account['name']) for account in accounts), self._codes)
+        ]
+
+        self._grams: defaultdict[str, list[int]] = defaultdict(list)
+
+        for position, name in enumerate(self._names):
+            for gram in {name[i:i + GRAM] for i in range(len(name) - GRAM + 1)}:
+                self._grams[gram].append(position)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def matches(self, query: str, candidates=None) -> list[int]:
+        # Positions of the accounts matching the normalized query, in order. Candidates narrows the search
+        # to the matches of a query the new query contains.
+        if candidates is None and len(query) < GRAM:
+            candidates = range(len(self._names))
+        elif candidates is None:
+            candidates = min((self._grams.get(query[i:i + GRAM], ()) for i in range(len(query) - GRAM + 1)), key=len)
+
+        return [position for position in candidates if query in self._names[position]]
+
+    def rank(self, position: int, query: str):
+        # Exact code matches first, then code prefixes, then word prefixes, then the other matches
+        code = self._codes[position]
+        name = self._names[position]
+
+        if code == query:
+            rank = 0
+        elif code.startswith(query):
+            rank = 1
+        elif name.startswith(query) or f' {query}' in name:
+            rank = 2
+        else:
+            rank = 3
+
+        return rank, position
+
+    def search(self, query: str, limit: int | None = None) -> list[dict]:
+        return AccountSearch(self).search(query, limit)
+
+
+class AccountSearch:
+    # Search of a single filter input over a shared index. When a query extends the previous one,
+    # only the previous matches are checked.
+
+    def __init__(self, index: AccountIndex):
+        self.index = index
+
+        self._query = ''
+        self._matches = None
+
+    def search(self, query: str, limit: int | None = None) -> list[dict]:
+        query = normalize(query)
+
+        if not query:
+            self._query = ''
+            self._matches = None
+
+            return list(self.index.accounts[:limit])
+
+        candidates = self._matches if self._query and self._query in query else None
+
+        self._matches = self.index.matches(query, candidates)
+        self._query = query
+
+        def rank(position):
+            return self.index.rank(position, query)
+
+        if limit is None:
+            ranked = sorted(self._matches, key=rank)
+        else:
+            ranked = heapq.nsmallest(limit, self._matches, key=rank)
+
+        return [self.index.accounts[position] for position in ranked]
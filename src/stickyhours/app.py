@@ -10,11 +10,8 @@ from asyncio import timeout
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from pprint import pprint
 from typing import List, Self
 
-import freezegun
-import platformdirs
 import pytz
 import toga
 import configparser
@@ -24,14 +21,26 @@ from toga.style.pack import COLUMN
 import toga.platform
 
 from stickyhours.lang import Lang
-from .commonFreeHours import get_accounts, process_user_data, get_common_gaps
+from stickyhours.tracing import tracer
+from .commonFreeHours import get_accounts, process_appointments, compute_gaps, GAP_ENGINES, MIN_FREE_INTERVAL, \
+    LESSON_SECONDS, DayBuckets, appointment_fields
 from .accountentry import AccountEntry
+from .accountindex import AccountIndex
 
 from .zapi import *
 import stickyhours.utils as utils
-from .zapi.zermelo import get_school_year
+from .zapi.zermelo import get_school_year, MIN_TOKEN_SECONDS_LEFT
+from .zapi.resilience import RetryPolicy
 
-from babel.dates import format_date
+
+# Maximum amount of schedules fetched at the same time
+MAX_CONCURRENT_FETCHES = 6
+
+# Seconds the schedule of a user may take to fetch
+FETCH_TIMEOUT = 20
+
+# Size budget of the appointment cache in bytes
+CACHE_MAX_BYTES = 16 * 1024 * 1024
 
 
 class FontSize(Enum):
@@ -45,6 +54,7 @@ lang = Lang()
 _ = lang.translate
 
 
+# Development only, import freezegun when enabling this
 #@freezegun.freeze_time('17-10-2024')
 class stickyhours(toga.App):
     # For except hook
@@ -54,16 +64,22 @@ class stickyhours(toga.App):
         super().__init__()
         self.main_loaded = False
         self.accounts = []
+        self.account_index = None
+        # Whether the accounts were fetched this session, instead of only read from disk
+        self.accounts_refreshed = False
         self.common_gaps_cache: dict[str, list[dict[str, int]]] = {}
 
         self.zermelo = Zermelo()
+        # Fetches the schedules, created on the first computation
+        self.async_zermelo = None
 
-        logging.basicConfig(level=logging.DEBUG)
+        logging.basicConfig(level=logging.WARNING)
         
     @property
     def config_dir(self):
         # Workaround for config path to work with flatpak
-        
+        import platformdirs
+
         return Path(platformdirs.PlatformDirs().user_config_dir) / self.app_name
 
     def startup(self):
@@ -94,6 +110,43 @@ class stickyhours(toga.App):
 
         self.user_config = self.config['user']
 
+        try:
+            logging.getLogger().setLevel(self.config.get('options', 'log_level', fallback='WARNING').upper())
+        except ValueError as e:
+            logging.warning(f"Invalid log level: {e}")
+
+        # Spans and request statistics are only recorded when a trace file is configured
+        self.trace_file = self.config.get('options', 'trace_file', fallback=None)
+        tracer.enabled = bool(self.trace_file)
+
+        self.max_concurrent_fetches = max(
+            1, self.config.getint('options', 'max_concurrent_fetches', fallback=MAX_CONCURRENT_FETCHES))
+
+        self.gap_engine = self.config.get('options', 'gap_engine', fallback='bitset')
+        if self.gap_engine not in GAP_ENGINES:
+            logging.warning(f"Unknown gap engine {self.gap_engine}, using bitset")
+            self.gap_engine = 'bitset'
+
+        self.min_free_seconds = self.config.getint('options', 'min_free_minutes', fallback=MIN_FREE_INTERVAL // 60) * 60
+        self.lesson_seconds = self.config.getint('options', 'lesson_minutes', fallback=LESSON_SECONDS // 60) * 60
+
+        # Keep a pooled connection available for every concurrent fetch
+        self.zermelo.pool_size = max(self.zermelo.pool_size, self.max_concurrent_fetches)
+
+        # A retry waits and times out within request_retry_seconds of the first attempt of the request, so only
+        # the first attempt can take the whole request timeout. The budget is kept below the fetch timeout.
+        self.zermelo.retry = RetryPolicy(
+            max_attempts=max(1, self.config.getint('options', 'request_attempts', fallback=3)),
+            max_elapsed=min(FETCH_TIMEOUT, self.config.getfloat('options', 'request_retry_seconds', fallback=10.0))
+        )
+
+        self.zermelo.cache = AppointmentCache(
+            self.config_dir / 'cache' / 'appointments',
+            max_bytes=self.config.getint('options', 'cache_max_bytes', fallback=CACHE_MAX_BYTES)
+        )
+        self.zermelo.horizons = HorizonStore(self.config_dir / 'cache' / 'horizons.json')
+        self.directory = DirectoryStore(self.config_dir / 'cache' / 'directories')
+
         self.login_setup()
         self.main_setup()
 
@@ -103,24 +156,78 @@ class stickyhours(toga.App):
             logging.info(f"Empty value in user in config, logging in again.")
             self.login_view()
         else:
-            try:
-                self.zermelo.token_login(self.user_config.get('token'), self.user_config.get('instance_id'))
-                logging.info(
-                    f"Logged in with existing token with account on {self.user_config.get('instance_id')}")
-                self.get_account_options()
-                self.main()
-
-            except ZermeloAuthException:
-                logging.info("Auth error, token invalid")
-                self.login_view()
-
-            except Exception as e:
-                logging.info("Logging in failed")
-                logging.debug(f"Logging in error: {e}")
-                self.handle_exception(e, show_error_view=True)
+            # The window is shown right away, the account is loaded in the background
+            self.loading_view()
+            self.startup_task = self.loop.create_task(self.startup_pipeline())
 
         self.main_window.show()
 
+    async def startup_pipeline(self):
+        # Logs in with the stored token and runs the lookups the main view needs concurrently. The token is only
+        # checked when its stored expiry is unknown or near, a rejected token fails the other lookups as well.
+        instance_id = self.user_config.get('instance_id')
+
+        def run(func):
+            return asyncio.wait_for(self.loop.run_in_executor(None, func), timeout=20)
+
+        try:
+            self.zermelo.token_login(self.user_config.get('token'), instance_id, check=False)
+
+            lookups = [run(self.zermelo.get_user), run(self.zermelo.get_settings), run(self.get_account_options)]
+
+            if self.token_expires() - time.time() <= MIN_TOKEN_SECONDS_LEFT:
+                lookups.append(run(self.check_token))
+
+            with tracer.span('startup', lookups=len(lookups)):
+                await asyncio.gather(*lookups)
+
+            logging.info(f"Logged in with existing token with account on {instance_id}")
+
+        except ZermeloAuthException:
+            logging.info("Auth error, token invalid")
+            self.login_view()
+            return
+
+        except asyncio.TimeoutError:
+            await self.main_window.error_dialog(_('error.timeout.title'), _('error.timeout.message'))
+            self.error_view(_('error.timeout.message'), False)
+            return
+
+        except Exception as e:
+            logging.info("Logging in failed")
+            logging.debug(f"Logging in error: {e}")
+            self.handle_exception(e, show_error_view=True)
+            return
+
+        self.main()
+        self.export_trace()
+
+    def token_expires(self):
+        # Stored epoch the token expires at, 0 when unknown
+        try:
+            return self.user_config.getint('token_expires', fallback=0)
+        except ValueError:
+            return 0
+
+    def check_token(self):
+        # Checks the token and stores when it expires, so the next launches can skip the check
+        with tracer.span('token_check'):
+            expires = self.zermelo.get_token_expires(self.zermelo.get_token(), self.zermelo.get_instance_id())
+
+        if expires - time.time() <= MIN_TOKEN_SECONDS_LEFT:
+            logging.info("Nearly expired token")
+            raise ZermeloAuthException('Nearly expired token')
+
+        self.user_config['token_expires'] = str(int(expires))
+        self.save_config()
+
+    def save_config(self):
+        if not self.config_dir.exists():
+            self.config_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(self.config_dir / 'stickyhours.ini', 'w') as f:
+            self.config.write(f)
+
     def handle_exception(self, exception: Exception, show_error_view: bool = False):
         logging.error(f"Handling exception: {exception}")
 
@@ -169,16 +276,72 @@ class stickyhours(toga.App):
         if self.accounts:
             return self.accounts
         try:
-            self.accounts = get_accounts(self.zermelo, get_school_year())
+            # Shown from disk right away, refresh_accounts updates them in the background
+            stored = self.directory.get(self.zermelo.get_instance_id(), get_school_year())
+            if stored:
+                self.accounts = tuple(stored)
+                return self.accounts
+
+            with tracer.span('accounts'):
+                # A tuple, so the account index shares it instead of copying it
+                self.accounts = tuple(get_accounts(self.zermelo, get_school_year()))
+            self.accounts_refreshed = True
+            self.directory.put(self.zermelo.get_instance_id(), get_school_year(), self.accounts)
             return self.accounts
         except ZermeloAuthException:
             return []
         except Exception as e:
             raise e
 
+    async def refresh_accounts(self):
+        # Fetches the directory after the stored one is shown, entries are only updated when it changed
+        school_year = get_school_year()
+
+        try:
+            instance_id = self.zermelo.get_instance_id()
+
+            with tracer.span('accounts', refresh=True):
+                accounts = await asyncio.wait_for(
+                    self.loop.run_in_executor(None, get_accounts, self.zermelo, school_year),
+                    timeout=60
+                )
+        except Exception as e:
+            logging.warning(f"Refreshing the accounts failed: {e!r}")
+            return
+
+        # Likely a failed or partial lookup, the shown accounts are kept instead of emptying every entry
+        if not accounts:
+            logging.warning("Refreshed accounts are empty, keeping the stored accounts")
+            return
+
+        self.accounts_refreshed = True
+
+        if not self.directory.put(instance_id, school_year, accounts):
+            logging.info("Accounts unchanged")
+            return
+
+        logging.info(f"Accounts changed, updating {len(self.entries)} entries")
+
+        self.accounts = tuple(accounts)
+        self.account_index = None
+
+        for entry in self.entries:
+            entry.apply_filter()
+
+    def get_account_index(self):
+        # Built once per account list, the single account source shared by all entries. Called on the ui thread,
+        # so it only uses the loaded accounts, they are fetched by get_account_options in an executor.
+        if self.account_index is None:
+            accounts = self.accounts
+
+            with tracer.span('account_index', accounts=len(accounts)):
+                self.account_index = AccountIndex(accounts)
+
+        return self.account_index
+
     def add_entry(self, widget=None, value=None):
         new_entry = AccountEntry(controller=self,
-                                 options_func=self.get_account_options,
+                                 index_func=self.get_account_index,
                                  add_button_translation=_('main.button.remove_entry'),
                                  filter_placeholder_translation=_('main.placeholder.filter_entry'),
                                  value=value
@@ -257,6 +420,10 @@ class stickyhours(toga.App):
 
         self.main_window.content = self.main_container
 
+        # The accounts came from disk, fetch the current ones without blocking the window
+        if not self.accounts_refreshed:
+            self.accounts_task = self.loop.create_task(self.refresh_accounts())
+
     def login_setup(self):
         async def help_portal_id(widget):
             utils.open_url(self.app.home_page + '#faq-zermelo-portal-id')
@@ -336,6 +503,14 @@ class stickyhours(toga.App):
 
         self.main_window.content = self.login_box
 
+    def loading_view(self):
+        self.main_window.title = self.formal_name
+
+        self.main_window.content = toga.Box(
+            children=[toga.Label(_('main.label.loading'), style=Pack(font_size=FontSize.l.value))],
+            style=Pack(direction=COLUMN, padding=10)
+        )
+
     def error_view(self, message, show_traceback):
         self.main_window.title = f"{_('error.window.title')} - {self.formal_name}"
 
@@ -353,6 +528,19 @@ class stickyhours(toga.App):
 
         self.main_window.content = error_box
 
+    def traced_code_login(self, code, instance_id):
+        with tracer.span('login', instance=instance_id):
+            self.zermelo.code_login(code, instance_id)
+
+    def export_trace(self):
+        if not self.trace_file:
+            return
+
+        try:
+            tracer.export(self.trace_file)
+        except OSError as e:
+            logging.error(f"Could not export trace to {self.trace_file}: {e}")
+
     async def login_help(self, widget):
         utils.open_url(self.app.home_page.rstrip('/') + '#faq-how-to-log-in')
         pass
@@ -376,7 +564,7 @@ class stickyhours(toga.App):
             await asyncio.wait_for(
                 self.loop.run_in_executor(
                     None,
-                    self.zermelo.code_login,
+                    self.traced_code_login,
                     self.zermelo_linkcode.value, self.zermelo_school_input.value
                 ),
                 timeout=20
@@ -417,13 +605,11 @@ class stickyhours(toga.App):
 
         self.user_config['instance_id'] = self.zermelo_school_input.value.strip()
         self.user_config['token'] = self.zermelo.get_token()
+        # Unknown until the token is checked on the next launch
+        self.user_config['token_expires'] = ''
 
         try:
-            if not self.config_dir.exists():
-                self.config_dir.mkdir(parents=True, exist_ok=True)
-
-            with open(self.config_dir / 'stickyhours.ini', 'w') as f:
-                self.config.write(f)
+            self.save_config()
         except Exception as e:
             done()
             self.handle_exception(e)
@@ -446,15 +632,89 @@ class stickyhours(toga.App):
 
     def logout_zermelo(self):
         self.accounts = []
+        self.account_index = None
         self.zermelo.logout()
+        self.close_async_zermelo()
+        self.zermelo.cache.clear()
+        self.directory.clear()
+        self.accounts_refreshed = False
         self.user_config['token'] = ''
+        self.user_config['token_expires'] = ''
         self.login_view()
 
-        with open(self.config_dir / 'stickyhours.ini', 'w') as f:
-            self.config.write(f)
+        self.save_config()
 
         logging.info("Logged out")
 
+    async def get_async_zermelo(self):
+        # The AsyncZermelo the schedules are fetched with, logged in with the token of self.zermelo and sharing its
+        # cache, horizons and retry policy. Imported here, so httpx is not imported at startup.
+        from .zapi import AsyncZermelo
+
+        token, instance_id = self.zermelo.get_token(), self.zermelo.get_instance_id()
+
+        # Logged in again since it was created
+        if self.async_zermelo is not None and (
+                self.async_zermelo.token != token or self.async_zermelo.instance_id != instance_id):
+            self.close_async_zermelo()
+
+        if self.async_zermelo is None:
+            self.async_zermelo = AsyncZermelo(
+                pool_size=self.max_concurrent_fetches,
+                timeout=self.zermelo.timeout,
+                cache=self.zermelo.cache,
+                incremental_sync=self.zermelo.incremental_sync,
+                horizons=self.zermelo.horizons,
+                timezone=self.zermelo.timezone,
+                base_url=self.zermelo.base_url,
+                max_concurrency=self.max_concurrent_fetches,
+                retry=self.zermelo.retry
+            )
+            await self.async_zermelo.token_login(token, instance_id, check=False)
+
+        return self.async_zermelo
+
+    def close_async_zermelo(self):
+        if self.async_zermelo is None:
+            return
+
+        self.loop.create_task(self.async_zermelo.aclose())
+        self.async_zermelo = None
+
+    async def fetch_appointments(self, users, weeks):
+        # Fetches the appointments of all users concurrently, with at most max_concurrent_fetches in flight.
+        # A fetch that times out is cancelled with its requests before its slot is released.
+        # A failing user does not cancel the others, its exception is returned in place of the appointments.
+        zermelo = await self.get_async_zermelo()
+        semaphore = asyncio.Semaphore(self.max_concurrent_fetches)
+
+        async def fetch(user):
+            # Only the fields the gap engine reads are requested
+            fields = appointment_fields(self.gap_engine, user.teacher)
+
+            async with semaphore:
+                logging.info(f"Fetching {user.id}")
+                self.compute_button.text = _('main.button.fetching.user').format(user.id)
+
+                try:
+                    with tracer.span('fetch', user=user.id, weeks=weeks):
+                        return await asyncio.wait_for(
+                            zermelo.get_current_weeks_appointments(user.id, user.teacher, weeks, True, fields=fields),
+                            timeout=FETCH_TIMEOUT
+                        )
+                except Exception as e:
+                    logging.info(f"Fetching {user.id} failed: {e!r}")
+                    return e
+
+        return await asyncio.gather(*[fetch(user) for user in users])
+
+    def process_appointments(self, appointments, user_id, buckets):
+        return process_appointments(appointments, user_id, self.gap_engine, buckets)
+
+    def compute_gaps(self, processed_appointments, sticky_hours):
+        return compute_gaps(processed_appointments, self.gap_engine, sticky_hours, self.min_free_seconds,
+                            self.lesson_seconds)
+
     async def compute(self, widget=None):
         def done():
             self.compute_button.enabled = True
@@ -478,16 +738,32 @@ class stickyhours(toga.App):
                 ids.append(entry.get_value().id)
 
         try:
-            processed_appointments = []
+            # Fetch the settings once up front, so the concurrent fetches don't all request them
+            await asyncio.wait_for((await self.get_async_zermelo()).get_settings(), timeout=FETCH_TIMEOUT)
+
+            fetched = await self.fetch_appointments(entries, int(self.weeks_amount_input.value.amount))
+
+            errors = [a for a in fetched if isinstance(a, Exception)]
+
+            # An expired session fails every user, and without any schedule there is nothing to compute
+            for error in errors:
+                if isinstance(error, ZermeloAuthException) or len(errors) == len(entries):
+                    raise error
 
-            for v in set(entries):
-                logging.info(f"Fetching {v.id}")
-                self.compute_button.text = _('main.button.fetching.user').format(v.id)
+            # The other users whose fetch failed are left out and reported
+            if errors:
+                failed = [v.id for v, a in zip(entries, fetched) if isinstance(a, Exception)]
+                entries, fetched = zip(*[(v, a) for v, a in zip(entries, fetched) if not isinstance(a, Exception)])
+
+                await self.main_window.error_dialog(_('main.message.fetch_failed_user.title'),
+                                                    _('main.message.fetch_failed_user.message').format(', '.join(failed)))
+
+            processed_appointments = []
 
-                a = await asyncio.wait_for(
-                    self.loop.run_in_executor(None, self.zermelo.get_current_weeks_appointments, v.id, v.teacher,
-                                              int(self.weeks_amount_input.value.amount), True), timeout=20)
+            # Shared by all users, so the local days are computed once
+            buckets = DayBuckets(self.zermelo.timezone)
 
+            for v, a in zip(entries, fetched):
                 if not a or a == {}:
                     done()
                     await self.main_window.error_dialog(_('main.message.no_schedule_user.title'), _('main.message.no_schedule_user.message').format(v.id))
@@ -496,14 +772,18 @@ class stickyhours(toga.App):
                 logging.info(f"Processing {v.id}")
                 self.compute_button.text = _('main.button.processing.user').format(v.id)
 
-                g = process_user_data(a, v.id)
-                if not g:
+                with tracer.span('process', user=v.id):
+                    g = self.process_appointments(a, v.id, buckets)
+                # The minutes engine returns no days at all, the slot engines an empty list of days
+                if not g or (self.gap_engine != 'minutes' and not g['days']):
                     logging.error(f"No valid appointments found for {v.id}")
-                    processed_appointments = []
-                    break
+                    done()
+                    await self.main_window.error_dialog(_('main.message.no_schedule_user.title'), _('main.message.no_schedule_user.message').format(v.id))
+                    return
                 processed_appointments.append(g)
 
-            self.common_gaps_cache = get_common_gaps(processed_appointments, sticky_hours=self.sticky_amount_input.value.amount)
+            with tracer.span('gaps', engine=self.gap_engine, users=len(processed_appointments)):
+                self.common_gaps_cache = self.compute_gaps(processed_appointments, self.sticky_amount_input.value.amount)
 
         except asyncio.TimeoutError:
             # Handle timeout
@@ -517,6 +797,11 @@ class stickyhours(toga.App):
 
         self.compute_button.text = _('main.button.listing')
 
+        # Only needed once results are shown, not at startup
+        from babel.dates import format_date
+
+        render_start = time.perf_counter_ns()
+
         self.result_box.clear()
 
         self.result_box.add(
@@ -538,7 +823,7 @@ class stickyhours(toga.App):
             self.result_box.add(
                 toga.Label(
                     "\n" + format_date(
-                        datetime.fromisoformat(day),
+                        DayBuckets.to_date(day),
                         format='full',
                         locale=lang.lang
                     ),
@@ -551,12 +836,12 @@ class stickyhours(toga.App):
             for gap in sorted_gaps:
                 start = datetime.fromtimestamp(
                     gap.get('start_time'),
-                    tz=pytz.timezone('Europe/Amsterdam')
+                    tz=pytz.timezone(self.zermelo.timezone)
                 )
 
                 end = datetime.fromtimestamp(
                     gap.get('end_time'),
-                    tz=pytz.timezone('Europe/Amsterdam')
+                    tz=pytz.timezone(self.zermelo.timezone)
                 )
 
                 self.result_box.add(toga.Label(
@@ -566,6 +851,9 @@ class stickyhours(toga.App):
         if not self.common_gaps_cache:
             self.result_box.add(toga.Label(f'\n{_('main.results.none')}', style=Pack(font_size=FontSize.l.value)))
 
+        tracer.add_span('render', render_start, time.perf_counter_ns())
+        self.export_trace()
+
         self.compute_button.text = _('main.button.idle')
         self.compute_button.enabled = True
 
@@ -0,0 +1,240 @@
+"""
+Headless batch computation of common free hours, without the gui.
+
+Reads groups of user codes from a file, one group per line, and writes the common gaps of every group as
+json lines. Every user is fetched and processed once, no matter in how many groups it is.
+
+    python -m stickyhours.cli groups.txt --weeks 2 --output gaps.jsonl
+"""
+import argparse
+import configparser
+import json
+import logging
+import sys
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from stickyhours.commonFreeHours import GAP_ENGINES, LESSON_SECONDS, MIN_FREE_INTERVAL, DayBuckets, appointment_fields, \
+    compute_gaps, process_appointments
+from stickyhours.tracing import tracer
+from stickyhours.zapi import AppointmentCache, HorizonStore, Zermelo
+from stickyhours.zapi.cache import DEFAULT_MAX_BYTES
+from stickyhours.zapi.exceptions import ZermeloAuthException, ZermeloException
+from stickyhours.zapi.zermelo import DEFAULT_BASE_URL
+
+APP_NAME = 'stickyhours'
+
+# Maximum amount of schedules fetched at the same time
+MAX_CONCURRENT_FETCHES = 6
+
+
+def default_config_dir():
+    # Same directory the app reads its config from
+    import platformdirs
+
+    return Path(platformdirs.PlatformDirs().user_config_dir) / APP_NAME
+
+
+def read_groups(lines):
+    # One group per line, user codes separated by whitespace or commas. Empty lines and # comments are skipped.
+    groups = []
+
+    for line in lines:
+        line = line.split('#', 1)[0]
+        users = list(dict.fromkeys(user for user in line.replace(',', ' ').split()))
+
+        if users:
+            groups.append(users)
+
+    return groups
+
+
+def positive_int(value):
+    number = int(value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not at least 1")
+
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m stickyhours.cli',
+                                     description='Compute the common free hours of groups of users.')
+    parser.add_argument('groups', type=argparse.FileType('r', encoding='utf-8'),
+                        help="file with one group of user codes per line, '-' for stdin")
+    parser.add_argument('-o', '--output', default='-', help="json lines output file, '-' for stdout")
+    parser.add_argument('--config', type=Path, help='stickyhours.ini to read the token and options from')
+    parser.add_argument('--token', help='zermelo token, overrides the config')
+    parser.add_argument('--instance', help='zermelo instance id, overrides the config')
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL, help=argparse.SUPPRESS)
+    parser.add_argument('--cache-dir', type=Path, help='cache directory, defaults to the cache of the app')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache appointments on disk')
+    parser.add_argument('--weeks', type=positive_int, default=1, help='amount of weeks from the current week')
+    parser.add_argument('--sticky', type=int, default=0, help='amount of sticky hours')
+    parser.add_argument('--engine', choices=sorted(GAP_ENGINES), help='gap engine, defaults to the config or bitset')
+    parser.add_argument('--min-free-minutes', type=int, help='minimum gap length of the minutes engine')
+    parser.add_argument('--lesson-minutes', type=positive_int,
+                        help='lesson length the minutes engine converts the sticky hours with')
+    parser.add_argument('--workers', type=int, help='maximum amount of schedules fetched at the same time')
+    parser.add_argument('--trace-file', help='export a trace of the run to this file')
+    parser.add_argument('--log-level', default='WARNING')
+
+    return parser.parse_args(argv)
+
+
+def fetch_users(zermelo: Zermelo, users, weeks, engine, workers):
+    # Fetches and processes every user once. Returns the processed appointments per user and the error per failed user.
+    processed = {}
+    errors = {}
+
+    # Shared by all users, so the local days are computed once
+    buckets = DayBuckets(zermelo.timezone)
+
+    # Only the fields the engine reads. Whether a user teaches is unknown here, so the teachers list is kept.
+    fields = appointment_fields(engine)
+
+    def fetch(user):
+        with tracer.span('fetch', user=user, weeks=weeks):
+            return zermelo.get_current_weeks_appointments(user, False, weeks, True, fields=fields)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, user): user for user in users}
+
+        # Processed in the main thread as the schedules arrive
+        for future in as_completed(futures):
+            user = futures[future]
+
+            try:
+                appointments = future.result()
+            except ZermeloAuthException:
+                raise
+            except ZermeloException as e:
+                logging.warning(f"Fetching {user} failed: {e}")
+                errors[user] = str(e)
+                continue
+
+            with tracer.span('process', user=user):
+                data = process_appointments(appointments or [], user, engine, buckets)
+
+            if not data or (engine != 'minutes' and not data['days']):
+                errors[user] = 'No valid appointments'
+                continue
+
+            processed[user] = data
+
+    return processed, errors
+
+
+def group_result(group, processed, errors, engine, sticky, min_length, lesson_length=LESSON_SECONDS):
+    failed = {user: errors[user] for user in group if user in errors}
+
+    if failed:
+        return {'users': group, 'error': failed}
+
+    with tracer.span('gaps', engine=engine, users=len(group)):
+        gaps = compute_gaps([processed[user] for user in group], engine, sticky, min_length, lesson_length)
+
+    return {
+        'users': group,
+        'gaps': [
+            {'date': DayBuckets.to_date(day).isoformat(), **gap}
+            for day in sorted(gaps)
+            for gap in sorted(gaps[day], key=lambda gap: gap['start_time'])
+        ]
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr)
+
+    tracer.enabled = bool(args.trace_file)
+
+    config_dir = args.config.parent if args.config else None
+    if config_dir is None and not (args.token and args.instance):
+        config_dir = default_config_dir()
+
+    config = configparser.ConfigParser(allow_no_value=True)
+    if config_dir is not None:
+        config.read(args.config or config_dir / 'stickyhours.ini')
+
+    token = args.token or config.get('user', 'token', fallback='')
+    instance_id = args.instance or config.get('user', 'instance_id', fallback='')
+
+    if not token or not instance_id:
+        logging.error("No token and instance id given and none found in the config")
+        return 2
+
+    engine = args.engine or config.get('options', 'gap_engine', fallback='bitset')
+    if engine not in GAP_ENGINES:
+        logging.warning(f"Unknown gap engine {engine}, using bitset")
+        engine = 'bitset'
+
+    min_length = MIN_FREE_INTERVAL
+    if args.min_free_minutes is not None:
+        min_length = args.min_free_minutes * 60
+    elif config.has_option('options', 'min_free_minutes'):
+        min_length = config.getint('options', 'min_free_minutes') * 60
+
+    lesson_minutes = args.lesson_minutes or config.getint('options', 'lesson_minutes', fallback=LESSON_SECONDS // 60)
+
+    workers = max(1, args.workers or config.getint('options', 'max_concurrent_fetches',
+                                                   fallback=MAX_CONCURRENT_FETCHES))
+
+    # Opened by argparse, which reports a missing or unreadable file as a usage error
+    with (nullcontext(sys.stdin) if args.groups is sys.stdin else args.groups) as f:
+        groups = read_groups(f)
+
+    zermelo = Zermelo(pool_size=workers, base_url=args.base_url)
+
+    cache_dir = args.cache_dir or (config_dir / 'cache' if config_dir is not None else None)
+    if cache_dir is not None:
+        zermelo.horizons = HorizonStore(cache_dir / 'horizons.json')
+
+        if not args.no_cache:
+            zermelo.cache = AppointmentCache(
+                cache_dir / 'appointments',
+                max_bytes=config.getint('options', 'cache_max_bytes', fallback=DEFAULT_MAX_BYTES)
+            )
+
+    users = list(dict.fromkeys(user for group in groups for user in group))
+
+    try:
+        with tracer.span('token_check'):
+            zermelo.token_login(token, instance_id)
+
+        # Fetch the settings once up front, so the concurrent fetches don't all request them
+        zermelo.get_settings()
+
+        processed, errors = fetch_users(zermelo, users, args.weeks, engine, workers)
+    except ZermeloAuthException as e:
+        logging.error(f"Not logged in: {e}")
+        return 1
+    except ZermeloException as e:
+        logging.error(f"Fetching the schedules failed: {e}")
+        return 1
+    finally:
+        zermelo.close_session()
+
+    failed = 0
+
+    with (nullcontext(sys.stdout) if args.output == '-' else open(args.output, 'w', encoding='utf-8')) as f:
+        for group in groups:
+            result = group_result(group, processed, errors, engine, args.sticky, min_length, lesson_minutes * 60)
+            failed += 'error' in result
+
+            f.write(json.dumps(result) + '\n')
+
+    logging.info(f"Computed {len(groups) - failed} of {len(groups)} groups")
+
+    if args.trace_file:
+        tracer.export(args.trace_file)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,15 @@
 import logging
-from datetime import datetime
-from typing import List, TypedDict
+from bisect import bisect_right
+from datetime import date, datetime, time
+from typing import TYPE_CHECKING, Iterable, List, Self, TypedDict
 
 import pytz
 
-from stickyhours.zapi import Zermelo
+from stickyhours.zapi.dates import DEFAULT_TIMEZONE
+
+if TYPE_CHECKING:
+    # Only for the annotations, processing schedules does not need the api client
+    from stickyhours.zapi import Zermelo
 
 class Appointment(TypedDict):
     appointmentInstance: int
@@ -54,57 +59,154 @@ class WrappedResponse(TypedDict):
 
 type timeslot = dict[str, int]
 
+type interval = tuple[int, int]
+
+# Default minimum length in seconds of a common free interval
+MIN_FREE_INTERVAL = 30 * 60
+
+# Default length of a lesson in seconds, converts the sticky hours for the minutes engine
+LESSON_SECONDS = 50 * 60
+
+
+# Amount of seconds DayBuckets precomputes around an epoch outside its range
+EXTEND_SECONDS = 28 * 24 * 60 * 60
+
+
+class DayBuckets:
+    # Maps epochs to local days, which are integer ordinals (date.toordinal()). The epochs of the local midnights
+    # are computed once per day in the range and epochs are bucketed with a binary search over them.
+
+    def __init__(self, timezone: str = DEFAULT_TIMEZONE, start: int | None = None, end: int | None = None):
+        self.timezone = pytz.timezone(timezone)
+
+        # Ordinal of the first day and the epochs of the midnights starting each day, plus the midnight after the last day
+        self._first_day: int | None = None
+        self._midnights: list[int] = []
+
+        if start is not None and end is not None:
+            self.extend(start, end)
+
+    def _midnight(self, day: int) -> int:
+        return int(self.timezone.localize(datetime.combine(date.fromordinal(day), time())).timestamp())
+
+    def _local_day(self, epoch: int) -> int:
+        return datetime.fromtimestamp(epoch, tz=self.timezone).date().toordinal()
+
+    def extend(self, start: int, end: int):
+        # Makes sure the days from start up to and including end are precomputed, only missing days are computed
+        first_day = self._local_day(start)
+        last_day = self._local_day(end)
+
+        if self._first_day is None:
+            self._first_day = first_day
+            self._midnights = [self._midnight(day) for day in range(first_day, last_day + 2)]
+            return
+
+        current_last_day = self._first_day + len(self._midnights) - 2
+
+        if first_day < self._first_day:
+            self._midnights[:0] = [self._midnight(day) for day in range(first_day, self._first_day)]
+            self._first_day = first_day
+
+        if last_day > current_last_day:
+            self._midnights.extend(self._midnight(day) for day in range(current_last_day + 2, last_day + 2))
+
+    def day(self, epoch: int) -> int:
+        if not self._midnights or not self._midnights[0] <= epoch < self._midnights[-1]:
+            # Grow in steps, an input that is not precomputed is usually processed in order
+            self.extend(epoch - EXTEND_SECONDS, epoch + EXTEND_SECONDS)
+
+        return self._first_day + bisect_right(self._midnights, epoch) - 1
+
+    @staticmethod
+    def to_date(day: int) -> date:
+        return date.fromordinal(day)
 
-class ProcessedAppointments(TypedDict):
-    timeslots: dict[str, timeslot]
-    daily_appointments: dict[str, List[Appointment]]
-    days: list[str]
 
-def is_valid_appointment(appointment: Appointment, user_id: str) -> bool:
-    if not appointment.get('startTimeSlot') or not appointment.get('endTimeSlot'):
-        logging.warning(f"No start and/or end timeslot for appointment: {appointment}")
+class CompactAppointment:
+    # Appointment with only the fields the gap engines use. Whether the user teaches the appointment
+    # is decided once while parsing, instead of scanning the teachers list for every check.
+    __slots__ = ('start', 'end', 'start_slot', 'end_slot', 'has_groups', 'user_is_teacher')
+
+    def __init__(self, start: int, end: int, start_slot: int | None, end_slot: int | None, has_groups: bool,
+                 user_is_teacher: bool):
+        self.start = start
+        self.end = end
+        self.start_slot = start_slot
+        self.end_slot = end_slot
+        self.has_groups = has_groups
+        self.user_is_teacher = user_is_teacher
+
+    @classmethod
+    def from_appointment(cls, appointment: Appointment, user_id: str) -> Self:
+        has_groups = bool(appointment.get('groups'))
+
+        return cls(
+            appointment.get('start'),
+            appointment.get('end'),
+            appointment.get('startTimeSlot'),
+            appointment.get('endTimeSlot'),
+            has_groups,
+            not has_groups and user_id in (appointment.get('teachers') or ())
+        )
+
+    def __repr__(self):
+        return (f'CompactAppointment(start={self.start}, end={self.end}, start_slot={self.start_slot}, '
+                f'end_slot={self.end_slot}, has_groups={self.has_groups}, user_is_teacher={self.user_is_teacher})')
+
+
+class ProcessedAppointments(TypedDict):
+    # Keyed by the local day ordinal, see DayBuckets
+    timeslots: dict[int, timeslot]
+    daily_appointments: dict[int, List[CompactAppointment]]
+    days: list[int]
+
+def is_valid_appointment(appointment: CompactAppointment, user_id: str, require_timeslots: bool = True) -> bool:
+    if require_timeslots and (not appointment.start_slot or not appointment.end_slot):
+        logging.warning("No start and/or end timeslot for appointment: %s", appointment)
         return False
 
-    if not appointment.get('groups'):
+    if not appointment.has_groups:
 
-        if not user_id in appointment.get('teachers'):
-            logging.info(f'No group for appointment: {appointment}')
-            logging.info(
-                f'User not in teachers list for this appointment, skipping hour. (subjects: {appointment.get('subjects')})')
+        if not appointment.user_is_teacher:
+            logging.info('No group for appointment, user not in teachers list, skipping hour: %s', appointment)
             return False
         else:
-            logging.info(f'No group for this appointment but {user_id} is in teachers list: {appointment}')
+            logging.info('No group for this appointment but %s is in teachers list: %s', user_id, appointment)
 
     return True
 
 
-def process_user_data(appointments: List[Appointment], user_id: str) -> ProcessedAppointments:
-    timeslots: dict[str, dict[str, int]] = {}
-    daily_appointments: dict[str, list[Appointment]] = {}
+def process_user_data(appointments: Iterable[Appointment], user_id: str,
+                      buckets: DayBuckets | None = None) -> ProcessedAppointments:
+    if buckets is None:
+        buckets = DayBuckets()
+
+    timeslots: dict[int, dict[str, int]] = {}
+    daily_appointments: dict[int, list[CompactAppointment]] = {}
 
     for appointment in appointments:
+        appointment = CompactAppointment.from_appointment(appointment, user_id)
 
         if not is_valid_appointment(appointment, user_id):
             continue
 
-        date = str(datetime.fromtimestamp(
-            appointment.get('start'), tz=pytz.timezone('Europe/Amsterdam')).date()
-                   )
+        day = buckets.day(appointment.start)
 
-        if not timeslots.get(date):
-            timeslots[date] = {
-                'start': appointment.get('startTimeSlot'),
-                'end': appointment.get('endTimeSlot')
+        if not timeslots.get(day):
+            timeslots[day] = {
+                'start': appointment.start_slot,
+                'end': appointment.end_slot
             }
 
         else:
-            timeslots[date]['start'] = min(timeslots[date]['start'], appointment.get('startTimeSlot'))
-            timeslots[date]['end'] = max(timeslots[date]['end'], appointment.get('endTimeSlot'))
+            timeslots[day]['start'] = min(timeslots[day]['start'], appointment.start_slot)
+            timeslots[day]['end'] = max(timeslots[day]['end'], appointment.end_slot)
 
-        if not daily_appointments.get(date):
-            daily_appointments[date] = []
+        if not daily_appointments.get(day):
+            daily_appointments[day] = []
 
-        daily_appointments[date].append(appointment)
+        daily_appointments[day].append(appointment)
 
     return {
         'timeslots': timeslots,
@@ -112,126 +214,289 @@ def process_user_data(appointments: List[Appointment], user_id: str) -> Processe
         'days': list(timeslots.keys())
     }
 
-def get_common_gaps(data: list[ProcessedAppointments], sticky_hours: int = 0) -> dict[str, list[dict[str, int]]]:
+def get_common_gaps(data: list[ProcessedAppointments], sticky_hours: int = 0) -> dict[int, list[dict[str, int]]]:
+    if not data:
+        return {}
+
     common_dates: set = set.intersection(*[set(user_data['days']) for user_data in data])
-    common_dates: list[str] = sorted(list(common_dates))
+    common_dates: list[int] = sorted(list(common_dates))
 
-    merged_days: dict[str, dict] = {}
+    merged_days: dict[int, dict] = {}
 
     # Merge data into dates
-    for date in common_dates:
+    for day in common_dates:
         # Process each common date
-        logging.info(f'Processing date: {date}')
+        logging.info('Processing date: %s', day)
 
-        merged_days[date] = {}
+        merged_days[day] = {}
 
         for user_data in data:
-            day = user_data.get('daily_appointments').get(date)
+            appointments = user_data.get('daily_appointments').get(day)
 
-            for appointment in day:
+            for appointment in appointments:
 
-                for i in range(appointment.get('startTimeSlot'), appointment.get('endTimeSlot') + 1):
-                    if not merged_days[date].get(i):
-                        merged_days[date][i] = {
-                            'start': appointment.get('start'),
-                            'end': appointment.get('end')
+                for i in range(appointment.start_slot, appointment.end_slot + 1):
+                    if not merged_days[day].get(i):
+                        merged_days[day][i] = {
+                            'start': appointment.start,
+                            'end': appointment.end
                         }
                     else:
-                        merged_days[date][i]['start'] = min(merged_days[date][i]['start'], appointment.get('start'))
-                        merged_days[date][i]['end'] = max(merged_days[date][i]['end'], appointment.get('end'))
+                        merged_days[day][i]['start'] = min(merged_days[day][i]['start'], appointment.start)
+                        merged_days[day][i]['end'] = max(merged_days[day][i]['end'], appointment.end)
 
 
-    minimum_day_slots: dict[str, dict] = {}
+    minimum_day_slots: dict[int, dict] = {}
 
-    for date in common_dates:
+    for day in common_dates:
         for user_data in data:
-            slot = user_data.get('timeslots').get(date)
+            slot = user_data.get('timeslots').get(day)
 
-            if not minimum_day_slots.get(date):
-                minimum_day_slots[date] = slot
+            if not minimum_day_slots.get(day):
+                # Copied, the processed data is reused for other groups and must not be narrowed in place
+                minimum_day_slots[day] = dict(slot)
             else:
-                minimum_day_slots[date]['start'] = max(minimum_day_slots[date]['start'], slot['start'])
-                minimum_day_slots[date]['end'] = min(minimum_day_slots[date]['end'], slot['end'])
+                minimum_day_slots[day]['start'] = max(minimum_day_slots[day]['start'], slot['start'])
+                minimum_day_slots[day]['end'] = min(minimum_day_slots[day]['end'], slot['end'])
 
-    gaps: dict[str, list[dict[str, int]]] = {}
+    gaps: dict[int, list[dict[str, int]]] = {}
 
-    for date in sorted(merged_days.keys()):
-        logging.info(f'Processing common gaps: {date}')
-        previous_slot_number: int | None = None
-        for slot_number in sorted(merged_days[date].keys()):
+    for day in sorted(merged_days.keys()):
+        logging.info('Processing common gaps: %s', day)
+        # Compare every occupied slot with the previous one, also after a gap got rejected
+        slot_numbers = sorted(merged_days[day].keys())
+        for previous_slot_number, slot_number in zip(slot_numbers, slot_numbers[1:]):
 
-            if previous_slot_number is None:
-                pass
-            elif slot_number - previous_slot_number > 1:
+            if slot_number - previous_slot_number > 1:
 
                 start_slot = previous_slot_number + 1
                 end_slot = slot_number - 1
 
-                logging.info(f'Gap found at slot {start_slot} - {end_slot}')
+                logging.info('Gap found at slot %s - %s', start_slot, end_slot)
 
                 # Make sure the gap is not outside the minimum day slots
-                if not minimum_day_slots[date]['start'] - sticky_hours <= start_slot:
-                    logging.info(f'Gap start {start_slot} is lower than minimum {minimum_day_slots[date]['start'] - sticky_hours} on date {date}')
+                if not minimum_day_slots[day]['start'] - sticky_hours <= start_slot:
+                    logging.info('Gap start %s is lower than minimum %s on date %s', start_slot, minimum_day_slots[day]['start'] - sticky_hours, day)
                     continue
-                if not start_slot <= minimum_day_slots[date]['end'] + sticky_hours:
-                    logging.info(f'Gap start {start_slot} is higher than maximum {minimum_day_slots[date]['end'] + sticky_hours} on date {date}')
+                if not start_slot <= minimum_day_slots[day]['end'] + sticky_hours:
+                    logging.info('Gap start %s is higher than maximum %s on date %s', start_slot, minimum_day_slots[day]['end'] + sticky_hours, day)
                     continue
 
-                if not minimum_day_slots[date]['start'] - sticky_hours <= end_slot:
-                    logging.info(
-                        f'Gap end {end_slot} is lower than minimum {minimum_day_slots[date]['start'] - sticky_hours} on date {date}')
+                if not minimum_day_slots[day]['start'] - sticky_hours <= end_slot:
+                    logging.info('Gap end %s is lower than minimum %s on date %s', end_slot, minimum_day_slots[day]['start'] - sticky_hours, day)
                     continue
-                if not end_slot <= minimum_day_slots[date]['end'] + sticky_hours:
-                    logging.info(
-                        f'Gap end {end_slot} is higher than maximum {minimum_day_slots[date]['end'] + sticky_hours} on date {date}')
+                if not end_slot <= minimum_day_slots[day]['end'] + sticky_hours:
+                    logging.info('Gap end %s is higher than maximum %s on date %s', end_slot, minimum_day_slots[day]['end'] + sticky_hours, day)
                     continue
 
-                if not gaps.get(date):
-                    gaps[date] = []
+                if not gaps.get(day):
+                    gaps[day] = []
 
-                gaps[date].append({
+                gaps[day].append({
                     'start_slot': start_slot,
                     'end_slot': end_slot,
-                    'start_time': merged_days[date][previous_slot_number]['end'],
-                    'end_time': merged_days[date][slot_number]['start']
+                    'start_time': merged_days[day][previous_slot_number]['end'],
+                    'end_time': merged_days[day][slot_number]['start']
                 })
 
-            previous_slot_number = slot_number
+    return gaps
+
+def _slot_mask(start_slot: int, end_slot: int) -> int:
+    # Bitmask with the bits start_slot up to and including end_slot set
+    return (1 << (end_slot + 1)) - (1 << start_slot)
+
+
+def _zero_runs(mask: int):
+    # Yields (start, end) of every run of zero bits between the lowest and highest set bit
+    lowest = (mask & -mask).bit_length() - 1
+    free = ~mask & ((1 << mask.bit_length()) - 1) & ~((1 << lowest) - 1)
+
+    while free:
+        start = (free & -free).bit_length() - 1
+        run = free >> start
+        length = (run ^ (run + 1)).bit_length() - 1
+
+        yield start, start + length - 1
+
+        free &= ~(((1 << length) - 1) << start)
+
+
+def get_common_gaps_bitset(data: list[ProcessedAppointments], sticky_hours: int = 0) -> dict[int, list[dict[str, int]]]:
+    # Same result as get_common_gaps, but the occupied slots of every user-day are a bitmask
+    # and the occupied slots of the group are the bitwise or of those masks.
+    if not data:
+        return {}
+
+    common_dates: list[int] = sorted(set.intersection(*[set(user_data['days']) for user_data in data]))
+
+    gaps: dict[int, list[dict[str, int]]] = {}
+
+    for day in common_dates:
+        user_days = [user_data['daily_appointments'][day] for user_data in data]
+        day_slots = [user_data['timeslots'][day] for user_data in data]
+
+        occupied = 0
+        for user_day in user_days:
+            for appointment in user_day:
+                occupied |= _slot_mask(appointment.start_slot, appointment.end_slot)
+
+        # Gaps are only allowed within the latest start and the earliest end of the users, widened by sticky_hours
+        minimum = max(slot['start'] for slot in day_slots) - sticky_hours
+        maximum = min(slot['end'] for slot in day_slots) + sticky_hours
+
+        for start_slot, end_slot in _zero_runs(occupied):
+            if not (minimum <= start_slot <= maximum and minimum <= end_slot <= maximum):
+                continue
+
+            # The gap starts at the latest end of the slot before it and ends at the earliest start of the slot after it
+            gaps.setdefault(day, []).append({
+                'start_slot': start_slot,
+                'end_slot': end_slot,
+                'start_time': max(
+                    appointment.end for user_day in user_days for appointment in user_day
+                    if appointment.start_slot <= start_slot - 1 <= appointment.end_slot
+                ),
+                'end_time': min(
+                    appointment.start for user_day in user_days for appointment in user_day
+                    if appointment.start_slot <= end_slot + 1 <= appointment.end_slot
+                )
+            })
 
     return gaps
 
-def get_accounts(zermelo: Zermelo, school_year: int):
 
-    use_student_names = (not zermelo.get_user().get('isStudent') and zermelo.get_settings().get('employeeCanViewOwnSchedule')) or zermelo.get_settings().get('studentCanViewProjectNames')
+def process_user_intervals(appointments: Iterable[Appointment], user_id: str,
+                           buckets: DayBuckets | None = None) -> dict[int, list[interval]]:
+    # The (start, end) epochs of the appointments of a user per day, appointments without timeslots included
+    if buckets is None:
+        buckets = DayBuckets()
+
+    daily_intervals: dict[int, list[interval]] = {}
+
+    for appointment in appointments:
+        appointment = CompactAppointment.from_appointment(appointment, user_id)
+
+        if not is_valid_appointment(appointment, user_id, require_timeslots=False):
+            continue
+
+        day = buckets.day(appointment.start)
 
-    teachers = zermelo.get_teachers(school_year, fields='prefix,lastName,code')
+        daily_intervals.setdefault(day, []).append((appointment.start, appointment.end))
 
-    if use_student_names:
-        students = zermelo.get_students(school_year, fields='firstName,prefix,lastName,code')
-    else:
-        students = zermelo.get_students(school_year, fields='code')
+    return daily_intervals
+
+
+def get_common_free_intervals(data: list[dict[int, list[interval]]], min_length: int = MIN_FREE_INTERVAL,
+                              sticky_seconds: int = 0) -> dict[int, list[dict[str, int]]]:
+    # Common free time in seconds instead of timeslots. The intervals of all users on a date are sorted once
+    # and swept to merge them into busy blocks, the free time between those blocks is a gap.
+    if not data:
+        return {}
+
+    common_dates: list[int] = sorted(set.intersection(*[set(user_data.keys()) for user_data in data]))
+
+    gaps: dict[int, list[dict[str, int]]] = {}
+
+    for day in common_dates:
+        user_days = [user_data[day] for user_data in data]
+
+        # Like the timeslot engines, gaps are only allowed between the latest start and the earliest end of the users
+        minimum = max(min(start for start, _ in user_day) for user_day in user_days) - sticky_seconds
+        maximum = min(max(end for _, end in user_day) for user_day in user_days) + sticky_seconds
+
+        intervals = sorted(interval for user_day in user_days for interval in user_day)
+
+        busy_end = intervals[0][1]
+
+        for start, end in intervals[1:]:
+            if start > busy_end:
+                if start - busy_end >= min_length and minimum <= busy_end and start <= maximum:
+                    gaps.setdefault(day, []).append({
+                        'start_time': busy_end,
+                        'end_time': start
+                    })
+
+                busy_end = end
+            else:
+                busy_end = max(busy_end, end)
+
+    return gaps
+
+
+# Engines for computing the common gaps, selected with the gap_engine option.
+# The minutes engine works on the start and end times instead of the timeslots.
+GAP_ENGINES = {
+    'slots': get_common_gaps,
+    'bitset': get_common_gaps_bitset,
+    'minutes': get_common_free_intervals,
+}
+
+# Appointment fields each engine reads through CompactAppointment, only these are requested
+ENGINE_FIELDS = {
+    'slots': ('start', 'end', 'startTimeSlot', 'endTimeSlot', 'groups', 'teachers'),
+    'bitset': ('start', 'end', 'startTimeSlot', 'endTimeSlot', 'groups', 'teachers'),
+    'minutes': ('start', 'end', 'groups', 'teachers'),
+}
+
+# User fields the account directory reads, student names only when the instance allows showing them
+TEACHER_FIELDS = ('code', 'prefix', 'lastName')
+STUDENT_FIELDS = ('code',)
+STUDENT_NAME_FIELDS = ('code', 'firstName', 'prefix', 'lastName')
+
+
+def appointment_fields(engine: str = 'bitset', is_teacher: bool = True) -> str:
+    # The fields string to fetch the appointments of a user with. The teachers list is only read for
+    # appointments without groups that the user teaches, a student is never in it so it is left out.
+    return ",".join(field for field in ENGINE_FIELDS[engine] if is_teacher or field != 'teachers')
+
+
+def process_appointments(appointments: Iterable[Appointment], user_id: str, engine: str = 'bitset',
+                         buckets: DayBuckets | None = None) -> ProcessedAppointments | dict[int, list[interval]]:
+    # Processes the appointments of a user into the input of the engine
+    if engine == 'minutes':
+        return process_user_intervals(appointments, user_id, buckets)
+    return process_user_data(appointments, user_id, buckets)
+
+
+def compute_gaps(data: list, engine: str = 'bitset', sticky_hours: int = 0, min_length: int = MIN_FREE_INTERVAL,
+                 lesson_length: int = LESSON_SECONDS) -> dict[int, list[dict[str, int]]]:
+    # The minutes engine has no timeslots, the sticky hours are converted with the lesson length of the school
+    if engine == 'minutes':
+        return get_common_free_intervals(data, min_length=min_length, sticky_seconds=sticky_hours * lesson_length)
+    return GAP_ENGINES[engine](data, sticky_hours=sticky_hours)
+
+
+def get_accounts(zermelo: 'Zermelo', school_year: int):
+
+    use_student_names = (not zermelo.get_user().get('isStudent') and zermelo.get_settings().get('employeeCanViewOwnSchedule')) or zermelo.get_settings().get('studentCanViewProjectNames')
 
     accounts = []
 
-    for teacher in teachers:
-        name = f"{teacher['prefix']} {teacher['lastName']}" if teacher['prefix'] else f"{teacher['lastName']}"
-        accounts.append({"name": f"{name} ({teacher['code']})", "id": teacher['code'], 'teacher': True})
+    # Streamed, the users are turned into accounts while the response is downloaded. Closed by the with blocks,
+    # so a failing account does not keep the connection.
+    with zermelo.get_teachers(school_year, fields=",".join(TEACHER_FIELDS), stream=True) as teachers:
+        for teacher in teachers:
+            name = f"{teacher['prefix']} {teacher['lastName']}" if teacher['prefix'] else f"{teacher['lastName']}"
+            accounts.append({"name": f"{name} ({teacher['code']})", "id": teacher['code'], 'teacher': True})
 
-    for student in students:
-        name = []
+    student_fields = STUDENT_NAME_FIELDS if use_student_names else STUDENT_FIELDS
 
-        if use_student_names:
-            # can use student names
-            name.append(student.get('firstName'))
+    with zermelo.get_students(school_year, fields=",".join(student_fields), stream=True) as students:
+        for student in students:
+            name = []
 
-            if student.get('prefix'):
-                name.append(student.get('prefix'))
+            if use_student_names:
+                # can use student names
+                name.append(student.get('firstName'))
 
-            name.append(student.get('lastName'))
-            name.append(f'({student.get('code')})')
-        else:
-            name.append(student.get('code'))
+                if student.get('prefix'):
+                    name.append(student.get('prefix'))
+
+                name.append(student.get('lastName'))
+                name.append(f'({student.get('code')})')
+            else:
+                name.append(student.get('code'))
 
-        accounts.append({"name": " ".join(name), "id": student['code'], 'teacher': False})
+            accounts.append({"name": " ".join(name), "id": student['code'], 'teacher': False})
 
     return accounts
\ No newline at end of file
@@ -1,9 +1,6 @@
+import logging
 import re
 import string
-from pathlib import Path
-from pprint import pprint
-
-from stickyhours import utils
 
 languages = ["en", "nl"]
 
@@ -23,7 +20,8 @@ def extract_translations(file_path):
 
 class Lang:
     def __init__(self):
-        self.lang = utils.get_locale()
+        # The language is detected on first use, not when the app module is imported
+        self._lang = None
 
         self.languages = {'en': {'auth.button.help': 'Help',
                                  'auth.button.idle': 'Log in',
@@ -79,7 +77,13 @@ class Lang:
                                  'main.button.processing.user': 'Processing user {}',
                                  'main.button.remove_entry': 'Remove user',
                                  'main.label.entries': 'Users',
+                                 'main.label.loading': 'Loading your account...',
                                  'main.label.options': 'Options',
+                                 'main.message.fetch_failed_user.message': 'The schedules of {} could '
+                                                                           'not be fetched and are left '
+                                                                           'out.',
+                                 'main.message.fetch_failed_user.title': 'Not every schedule was '
+                                                                         'fetched',
                                  'main.message.no_schedule_user.message': 'User {} has no schedule '
                                                                           'available.',
                                  'main.message.no_schedule_user.title': 'No schedule found for user.',
@@ -145,7 +149,13 @@ class Lang:
                                  'main.button.processing.user': 'Gebruiker {} verwerken',
                                  'main.button.remove_entry': 'Gebruiker verwijderen',
                                  'main.label.entries': 'Gebruikers',
+                                 'main.label.loading': 'Account laden...',
                                  'main.label.options': 'Instellingen',
+                                 'main.message.fetch_failed_user.message': 'De roosters van {} konden '
+                                                                           'niet worden opgehaald en '
+                                                                           'zijn weggelaten.',
+                                 'main.message.fetch_failed_user.title': 'Niet alle roosters zijn '
+                                                                         'opgehaald',
                                  'main.message.no_schedule_user.message': 'Geen rooster gevonden voor '
                                                                           'gebruiker {}.',
                                  'main.message.no_schedule_user.title': 'Geen rooster gevonden',
@@ -158,21 +168,34 @@ class Lang:
                                  'main.selection.weeks_amount': 'Tot {} weken in de toekomst',
                                  'main.selection.weeks_amount.current': 'Alleen deze week'}}
 
-        print(f'Detected language {self.lang}')
+    @property
+    def lang(self):
+        if self._lang is None:
+            from stickyhours import utils
+
+            self._lang = utils.get_locale()
+
+            logging.info(f'Detected language {self._lang}')
 
-        if not self.languages.get(self.lang):
-            print('Defaulting to english')
-            self.lang = 'en'
+            if not self.languages.get(self._lang):
+                logging.info('Defaulting to english')
+                self._lang = 'en'
+
+        return self._lang
+
+    @lang.setter
+    def lang(self, value):
+        self._lang = value
 
     def translate(self, key: string):
 
         value: string = self.languages.get(self.lang, self.languages.get('en')).get(key, '')
 
         if value == '':
-            print('Missing key, rerun the script to regenerate keys')
+            logging.warning('Missing key, rerun the script to regenerate keys')
 
         if value == '' or value is None:
-            print(f'Empty key: {self.lang}/{key}')
+            logging.warning(f'Empty key: {self.lang}/{key}')
 
             if self.lang == 'en':
                 return key
@@ -182,12 +205,14 @@ class Lang:
             value = self.languages.get('en').get(key, key)
 
             if value == '':
-                print(f'Empty key: en/{key}')
+                logging.warning(f'Empty key: en/{key}')
                 value = key
 
         return value
 
 if __name__ == "__main__":
+    from pprint import pprint
+
     translations = {}
 
     lang = Lang()
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        self.tracer.add_span(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class _NullSpan:
+    # Returned while tracing is disabled, so a span costs next to nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    # Records timing spans and per endpoint request statistics.
+    # Exported as a json file in the chrome trace event format, which chrome://tracing and perfetto can open.
+
+    def __init__(self, enabled=False):
+        self.logger = logging.getLogger(__name__)
+
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+        self._events = []
+        self._requests = {}
+
+    def span(self, name, **args):
+        # Context manager timing the code in its block
+        if not self.enabled:
+            return _NULL_SPAN
+
+        return _Span(self, name, args)
+
+    def add_span(self, name, start, end, args=None):
+        # Start and end are time.perf_counter_ns() values
+        if not self.enabled:
+            return
+
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self._origin) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args or {}
+        }
+
+        with self._lock:
+            self._events.append(event)
+
+    def record_request(self, endpoint, status, size, seconds):
+        # Aggregates a request: amount, errors, bytes and latency per endpoint
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stats = self._requests.setdefault(endpoint, {
+                'count': 0,
+                'errors': 0,
+                'bytes': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0
+            })
+
+            stats['count'] += 1
+            stats['errors'] += status >= 400
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def requests(self):
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._requests.items()}
+
+    def export(self, path):
+        with self._lock:
+            trace = {
+                'traceEvents': list(self._events),
+                'requests': {endpoint: dict(stats) for endpoint, stats in self._requests.items()}
+            }
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+
+        self.logger.info(f"Exported trace with {len(trace['traceEvents'])} spans to {path}")
+
+    def reset(self):
+        with self._lock:
+            self._origin = time.perf_counter_ns()
+            self._events = []
+            self._requests = {}
+
+
+# Process wide tracer, disabled until enabled by the app or cli
+tracer = Tracer()
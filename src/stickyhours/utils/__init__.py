@@ -1,6 +1,8 @@
+import logging
+
 import toga.platform
 
-print(f"Initializing on platform: {toga.platform.get_current_platform()}")
+logging.debug(f"Initializing on platform: {toga.platform.get_current_platform()}")
 
 from .default import *
 
@@ -7,8 +7,6 @@ from toga.style import Pack
 
 platform = 'OTHER'
 
-locale.setlocale(locale.LC_ALL, '')
-
 button_style = Pack()
 
 icon_button_size = 32
@@ -20,6 +18,8 @@ def open_url(url: string):
 
 def get_locale():
     try:
+        # Set on first use instead of at import, getlocale needs the locale of the environment
+        locale.setlocale(locale.LC_ALL, '')
         return locale.getlocale()[0].split('_')[0]
     except locale.Error as e:
         logging.error("Failed to get locale: ", e)
@@ -1,4 +1,32 @@
-from .zermelo import Zermelo, get_school_year
+from .dates import get_school_year
 from .exceptions import *
 
-__version__ = 'dev-0.1'
\ No newline at end of file
+__version__ = 'dev-0.1'
+
+# Imported on first use, so importing the exceptions or date helpers does not import requests
+_lazy = {
+    'Zermelo': '.zermelo',
+    'AsyncZermelo': '.async_zermelo',
+    'AppointmentCache': '.cache',
+    'HorizonStore': '.cache',
+    'DirectoryStore': '.cache',
+    'ZermeloPool': '.pool',
+}
+
+# AsyncZermelo and ZermeloPool are left out, a star import would import them and httpx
+__all__ = ['Zermelo', 'get_school_year', 'AppointmentCache', 'HorizonStore', 'DirectoryStore',
+           'ZermeloException', 'ZermeloFunctionSettingsError', 'ZermeloValueError', 'ZermeloAuthException', 'ZermeloApiDataException',
+           'ZermeloApiNetworkError', 'ZermeloApiHttpStatusException', 'ZermeloCircuitOpenError',
+           'ZermeloPoolFullError']
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import importlib
+
+    value = getattr(importlib.import_module(_lazy[name], __name__), name)
+    globals()[name] = value
+
+    return value
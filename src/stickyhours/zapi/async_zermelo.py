@@ -0,0 +1,586 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+import pytz
+
+from stickyhours.tracing import tracer
+from stickyhours.zapi.cache import HorizonStore
+from stickyhours.zapi.dates import DEFAULT_TIMEZONE, get_school_year
+from stickyhours.zapi.exceptions import *
+from stickyhours.zapi.resilience import CircuitBreaker, RetryPolicy, parse_retry_after
+from stickyhours.zapi.zermelo import DEFAULT_APPOINTMENT_FIELDS, DEFAULT_BASE_URL, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, \
+    HorizonSearch, cache_fields, current_week_start, is_forbidden, merge_appointments, sync_params, validate_instance, \
+    weeks_end
+
+# Default maximum amount of requests in flight at once
+DEFAULT_MAX_CONCURRENCY = 20
+
+
+def httpx_timeout(timeout):
+    # A requests style (connect, read) timeout as an httpx timeout, seconds are used as is
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+
+    return timeout
+
+
+class AsyncZermelo:
+    # Asyncio variant of Zermelo, with the same methods as coroutines. Requests share one httpx connection pool
+    # and at most max_concurrency are in flight, the others wait without holding a thread. Cancelling the task
+    # awaiting a method cancels its request.
+
+    def __init__(self, api_version=3, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, cache=None,
+                 incremental_sync=True, horizons=None, timezone=DEFAULT_TIMEZONE, base_url=DEFAULT_BASE_URL,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, retry=None, breaker_threshold=5, breaker_reset=30.0):
+        self.logger = logging.getLogger(__name__)
+
+        self.api_version = api_version
+        self.base_url = base_url
+        self.timezone = timezone
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._client = None
+        self._semaphore = None
+
+        # Optional AppointmentCache for get_appointments
+        self.cache = cache
+        self.incremental_sync = incremental_sync
+
+        # Largest allowed amount of appointment weeks per instance and school year
+        self.horizons = horizons if horizons is not None else HorizonStore()
+
+        # Retries of failed requests, and a circuit breaker per instance
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._breakers = {}
+
+        self.instance_id = None
+        self.token = None
+        self.logged_in = False
+
+        self._settings = {}
+        self._user = None
+
+        # Concurrent callers wait for the lookup in flight instead of repeating it
+        self._user_lock = None
+        self._settings_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def get_url(self, instance_id, endpoint):
+        return f'{self.base_url.format(instance_id=instance_id, api_version=self.api_version)}/{endpoint.strip()}'
+
+    def get_client(self):
+        # The pooled client, created in the running event loop on first use
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx_timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+            # Capped at the pool size, a request that waits for a connection instead would hit the pool timeout
+            # and be retried as a network error
+            self._semaphore = asyncio.Semaphore(min(self.max_concurrency, self.pool_size))
+
+            self._user_lock = asyncio.Lock()
+            self._settings_lock = asyncio.Lock()
+
+        return self._client
+
+    def get_breaker(self, instance_id):
+        # Returns the circuit breaker of the instance
+        breaker = self._breakers.get(instance_id)
+
+        if breaker is None:
+            breaker = self._breakers[instance_id] = CircuitBreaker(instance_id, self.breaker_threshold,
+                                                                   self.breaker_reset)
+
+        return breaker
+
+    async def aclose(self):
+        # Closes the pooled connections
+        if self._client is None:
+            return
+
+        await self._client.aclose()
+        self._client = None
+
+    async def _request(self, method, url, endpoint, **kwargs):
+        # Sends a request within the concurrency limit, network errors are raised as ZermeloApiNetworkError
+        client = self.get_client()
+
+        async with self._semaphore:
+            try:
+                r = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                raise ZermeloApiNetworkError("Could not reach the zermelo servers")
+
+        tracer.record_request(endpoint, r.status_code, len(r.content), r.elapsed.total_seconds())
+
+        return r
+
+    async def _retry_request(self, instance_id, method, url, endpoint, **kwargs):
+        # _request with the retry policy and circuit breaker of send_request in Zermelo
+        breaker = self.get_breaker(instance_id)
+        timeout = kwargs.pop('timeout', self.timeout)
+        started = time.monotonic()
+        attempt = 0
+
+        while True:
+            breaker.before_request()
+
+            # A retry gets the time left of the retry budget at most
+            kwargs['timeout'] = httpx_timeout(self.retry.attempt_timeout(timeout, started) if attempt else timeout)
+
+            try:
+                r = await self._request(method, url, endpoint, **kwargs)
+            except ZermeloApiNetworkError:
+                breaker.record_failure()
+
+                delay = self.retry.next_delay(attempt, started) if self.retry.retryable(method) else None
+                if delay is None:
+                    raise
+
+                self.logger.warning("Could not reach %s, retrying in %.2f seconds", url, delay)
+            except BaseException:
+                # Any other error or a cancellation ends the request as well, an unrecorded trial request would
+                # keep the circuit open
+                breaker.record_failure()
+                raise
+            else:
+                if r.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+
+                delay = None
+                if self.retry.retryable(method, r.status_code):
+                    delay = self.retry.next_delay(attempt, started, parse_retry_after(r.headers.get('Retry-After')))
+
+                if delay is None:
+                    return r
+
+                self.logger.warning("Request returned %s, retrying in %.2f seconds", r.status_code, delay)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def require_setting(self, setting, value, endpoint=None, school_year=None):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        settings = await self.get_settings(school_year)
+
+        if settings.get(setting) != value:
+            raise ZermeloFunctionSettingsError(setting, settings.get(setting), value, endpoint)
+
+    async def get_schoolInSchoolYear(self, school_year=None):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        return (await self.get_settings(school_year)).get('schoolInSchoolYear')
+
+    async def get_user(self):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        self.get_client()
+
+        async with self._user_lock:
+            if not self._user:
+                self._user = (await self.send_request('GET', 'users/~me')).get('data')[0]
+
+        return self._user
+
+    async def get_settings(self, school_year=None):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        if school_year is None:
+            school_year = get_school_year(datetime.now())
+
+        self.get_client()
+
+        async with self._settings_lock:
+            if self._settings.get(school_year):
+                return self._settings.get(school_year)
+
+            SISYs = (await self.get_user()).get('schoolInSchoolYears')
+
+            params = {
+                "archived": "false",
+                "schoolInSchoolYear": ",".join(map(str, SISYs)),
+                "year": school_year,
+            }
+
+            d = await self.send_request('GET', 'schoolfunctionsettings', params=params)
+
+            try:
+                self._settings[school_year] = d.get('data')[0]
+            except IndexError:
+                raise ZermeloApiDataException('No response data in settings request.')
+
+        return self._settings[school_year]
+
+    async def _user_role(self):
+        return 'student' if (await self.get_user()).get('isStudent') else 'employee'
+
+    async def get_appointments(self, start: float, end: float, fields: str, user: str, is_teacher: bool = False,
+                               valid_only: bool = True):
+        # Gets the raw schedule from the api
+        self.logger.info("method get_appointments called")
+
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        await self.require_setting(f"{await self._user_role()}CanViewProjectSchedules", True, 'appointments',
+                                   get_school_year(datetime.fromtimestamp(start, tz=pytz.timezone(self.timezone))))
+
+        params = {
+            'start': int(start),
+            'end': int(end),
+            'user': user,
+            'fields': fields
+        }
+
+        if valid_only:
+            params['valid'] = True
+            params['cancelled'] = False
+
+        if self.cache is None:
+            return await self._request_appointments(params)
+
+        # The cache reads and writes files and merging is cpu bound, both run in a thread to keep the loop free
+        key = self.cache.key(self.instance_id, user, start, end, fields, valid_only)
+        entry = await asyncio.to_thread(self.cache.get, key)
+
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                self.logger.info("Serving appointments of %s from cache", user)
+                return entry.get('appointments')
+
+            if self.incremental_sync and entry.get('modified') is not None:
+                modified = entry.get('modified')
+                changes = await self._request_appointments(sync_params(params, modified)) or []
+
+                appointments, modified = await asyncio.to_thread(merge_appointments, entry.get('appointments'),
+                                                                 changes, modified, valid_only)
+                self.logger.info("Synced cached appointments of %s", user)
+                return (await asyncio.to_thread(self.cache.put, key, appointments, modified)).get('appointments')
+
+        params['fields'] = cache_fields(fields)
+
+        appointments = await self._request_appointments(params)
+
+        if appointments is not None:
+            await asyncio.to_thread(self.cache.put, key, appointments)
+
+        return appointments
+
+    async def _request_appointments(self, params):
+        try:
+            return (await self.send_request('GET', 'appointments', params=params)).get('data')
+        except ZermeloApiHttpStatusException as e:
+            # Not allowed to search for value, possibly due to summer holidays?
+            if e.status == 403:
+                raise ZermeloApiDataException(
+                    'No response data in appointments request due to 403 (forbidden). Check if you can access the schedules in the zermelo portal.')
+            raise e
+
+    async def get_current_weeks_appointments(self, user: str, is_teacher: bool = False, weeks: int = 1,
+                                             valid_only: bool = False, fix_403: bool = True,
+                                             fields=DEFAULT_APPOINTMENT_FIELDS,
+                                             max_weeks_optimization: bool = True):
+        # The appointments of the current week and the following weeks, probing the allowed horizon on a 403
+        self.logger.info("method get_current_weeks_appointments called")
+
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        school_year = get_school_year(datetime.now())
+
+        await self.require_setting(f"{await self._user_role()}CanViewProjectSchedules", True, 'appointments',
+                                   school_year)
+
+        start = current_week_start()
+
+        async def fetch(weeks_amount):
+            end = weeks_end(start, weeks_amount)
+            return await self.get_appointments(start.timestamp(), end.timestamp(), fields, user, is_teacher,
+                                               valid_only)
+
+        if not fix_403:
+            return await fetch(weeks)
+
+        # The horizons are stored in a file, read and written in a thread
+        search = await asyncio.to_thread(HorizonSearch, self.horizons, self.instance_id, school_year, weeks,
+                                         max_weeks_optimization)
+
+        try:
+            return await fetch(search.weeks)
+        except ZermeloApiDataException as e:
+            if not is_forbidden(e) or search.weeks <= 1:
+                raise e
+
+            error = e
+
+        self.logger.info(f"Probing the appointment horizon below {search.weeks} weeks")
+
+        while True:
+            middle = search.next_weeks()
+            if middle is None:
+                break
+
+            try:
+                search.allow(middle, await fetch(middle))
+            except ZermeloApiDataException as e:
+                if not is_forbidden(e):
+                    raise e
+                search.forbid(middle)
+
+        appointments = await asyncio.to_thread(search.result, error)
+        self.logger.info(f"Appointment horizon of {self.instance_id} in {school_year} is {search.allowed} weeks")
+
+        return appointments
+
+    async def _get_users(self, school_year, fields, role, student_setting, employee_setting, endpoint):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        if (await self.get_user()).get('isStudent'):
+            await self.require_setting(student_setting, True, endpoint, school_year)
+        else:
+            await self.require_setting(employee_setting, True, endpoint, school_year)
+
+        params = {
+            "schoolInSchoolYear": (await self.get_settings(school_year)).get('schoolInSchoolYear'),
+            role: "true",
+            "fields": fields
+        }
+
+        try:
+            return (await self.send_request('GET', 'users', params=params)).get('data')
+        except ZermeloApiHttpStatusException as e:
+            # Not allowed to search for value, possibly due to summer holidays?
+            if e.status == 403:
+                raise ZermeloApiDataException(
+                    'No response data in users request due to 403 (forbidden). Check if you can access the schedules in the zermelo portal.')
+            raise e
+
+    async def get_students(self, school_year: int = None, fields: str = None):
+        self.logger.info("method get_students called")
+
+        return await self._get_users(school_year, fields, 'isStudent', 'studentCanViewProjectSchedules',
+                                     'employeeCanViewProjectSchedules', 'studentsindepartments')
+
+    async def get_teachers(self, school_year: int = None, fields: str = None):
+        self.logger.info("method get_teachers called")
+
+        return await self._get_users(school_year, fields, 'isEmployee', 'studentCanViewRelatedTeacherSchedules',
+                                     'employeeCanViewColleagueSchedules', 'contracts')
+
+    async def send_request(self, method, endpoint, params=None, data=None, headers=None, timeout=None):
+        # Send requests, once logged in
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        url = self.get_url(self.instance_id, endpoint)
+
+        params = {**(params or {}), 'access_token': self.token}
+
+        self.logger.info("Request: %s %s", method, url)
+
+        kwargs = {'params': params, 'headers': headers}
+        if data is not None:
+            kwargs['json'] = data
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+
+        r = await self._retry_request(self.instance_id, method.upper(), url, endpoint, **kwargs)
+
+        if r.status_code == 401:
+            # Unauthorised, token is expired
+            self.token = None
+            self.instance_id = None
+            self.logged_in = False
+
+            raise ZermeloAuthException('Session expired')
+
+        if r.status_code >= 400:
+            raise ZermeloApiHttpStatusException(r.status_code, r.text)
+
+        try:
+            return r.json().get('response')
+        except json.decoder.JSONDecodeError:
+            return r.text
+
+    async def check_token(self, token, instance_id, min_seconds_left=60 * 60):
+        # Check if a token is valid
+        self.logger.info("method check_token called")
+
+        instance_id = instance_id.strip()
+        validate_instance(instance_id)
+
+        now_seconds = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
+
+        r = await self._request('GET', self.get_url(instance_id, 'tokens/~current'), 'tokens/~current',
+                                params={'access_token': token})
+
+        if r.status_code == 404:
+            self.logger.error(f"Instance {instance_id} does not exist.")
+            raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
+
+        if r.status_code == 401:
+            raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
+
+        if r.status_code >= 400:
+            raise ZermeloApiHttpStatusException(r.status_code, r.text)
+
+        try:
+            expires_seconds = r.json().get('response').get('data')[0].get('expires')
+        except (AttributeError, IndexError, json.decoder.JSONDecodeError):
+            self.logger.info(f"Invalid token: {token}")
+            return False
+
+        if expires_seconds - now_seconds > min_seconds_left:
+            self.logger.info(f"Token expires in {timedelta(seconds=expires_seconds - now_seconds)}")
+            return True
+        self.logger.info(f"Nearly expired token: {token}")
+        return False
+
+    async def token_login(self, token, instance_id, check=True):
+        # Logs in using the users token. Token validation can be disabled.
+        self.logger.info("method token_login called")
+
+        instance_id = instance_id.strip()
+        validate_instance(instance_id)
+
+        if check and not await self.check_token(token, instance_id):
+            raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
+
+        self.token = token
+        self.instance_id = instance_id
+        self.logged_in = True
+
+        self.logger.info("Logged in")
+
+    async def password_login(self, instance_id, user, password):
+        # Logs in using the users password. Zermelo doesnt allow this for everyone, so check their docs.
+        self.logger.warning("method password_login called")
+
+        instance_id = instance_id.strip()
+        validate_instance(instance_id)
+
+        data = {
+            'username': user.strip(),
+            'password': password.strip(),
+            'client_id': 'OAuthPage',
+            'redirect_uri': '/main/',
+            'scope': '',
+            'state': '4E252A',
+            'response_type': 'code',
+            'tenant': instance_id
+        }
+
+        r = await self._request('POST', self.get_url(instance_id, 'oauth'), 'oauth', data=data)
+
+        if r.status_code == 500:
+            self.logger.error(f"Instance {instance_id} does not exist.")
+            raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
+
+        if r.status_code >= 400:
+            raise ZermeloApiHttpStatusException(r.status_code, r.text)
+
+        # Get the url containing the authentication code
+        data_url = r.headers.get('Location', r.text)
+
+        if data_url.strip() == '':
+            raise ZermeloApiDataException('No data url forwarded in auth request.')
+
+        try:
+            code = parse_qs(urlparse(data_url).query).get('code')[0]
+        except TypeError:
+            # NoneType is not subscriptable
+            raise ZermeloAuthException("Incorrect password or user name")
+
+        await self.code_login(code, instance_id)
+
+    async def code_login(self, code, instance_id):
+        # Logs in using the 'connect app' code
+        self.logger.info("method code_login called")
+
+        code = code.strip()
+
+        instance_id = instance_id.strip()
+        validate_instance(instance_id)
+
+        data = {
+            'code': code,
+            'grant_type': 'authorization_code',
+            'rememberMe': 'true'
+        }
+
+        r = await self._request('POST', self.get_url(instance_id, 'oauth/token'), 'oauth/token', data=data)
+
+        if r.status_code == 404:
+            self.logger.error(f"Instance {instance_id} does not exist.")
+            raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
+        if r.status_code == 400:
+            # Zermelo returns a 400 when the linkcode is expired
+            raise ZermeloAuthException("Invalid linkcode")
+        if r.status_code >= 400:
+            raise ZermeloApiHttpStatusException(r.status_code, r.content)
+
+        token = json.loads(r.text).get('access_token', '')
+
+        # Invalid link code?
+        if token == '':
+            raise ZermeloAuthException('Linkcode expired.')
+
+        # Log in with token, dont validate because the token is correct
+        await self.token_login(token, instance_id, False)
+
+    async def logout(self, logged_out_ok=True):
+        self.logger.info("method logout called")
+
+        try:
+            await self.send_request('POST', 'oauth/logout')
+
+            self.token = None
+            self.instance_id = None
+            self.logged_in = False
+
+            self._settings = {}
+            self._user = None
+
+            self.logger.info("Logged out")
+        except ZermeloAuthException as e:
+            if not logged_out_ok:
+                raise e
+            self.logger.warning("Not logged in while logging out")
+        finally:
+            await self.aclose()
+
+    def get_token(self):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        return self.token
+
+    def get_instance_id(self):
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        return self.instance_id
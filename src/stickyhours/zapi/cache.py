@@ -0,0 +1,302 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+# Default size budget of the cache on disk in bytes
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# Default amount of seconds an entry is served without revalidating it
+DEFAULT_MAX_AGE = 5 * 60
+
+
+class AppointmentCache:
+    # Persistent cache of appointment responses, stored as one json file per entry.
+    # Entries are evicted least recently used first once the cache grows over max_bytes.
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # Size and last use of every entry, read from disk once and kept up to date afterwards,
+        # so storing an entry does not stat the whole cache. Ordered least recently used first.
+        self._lock = threading.Lock()
+        self._entries = None
+        self._total = 0
+
+    @staticmethod
+    def key(instance_id, user, start, end, fields, valid_only):
+        # Key of a week aligned range of appointments. The order of the fields does not matter.
+        fields = ",".join(sorted(field.strip() for field in fields.split(',')))
+        raw = json.dumps([instance_id, user, int(start), int(end), fields, valid_only])
+
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _file(self, key):
+        return self.path / f"{key}.json"
+
+    def _index(self):
+        # The entries by key, scanned from disk on first use. Call with the lock held.
+        if self._entries is None:
+            files = []
+
+            for file in self.path.glob('*.json'):
+                try:
+                    stat = file.stat()
+                except OSError:
+                    continue
+
+                files.append((stat.st_mtime, file.stem, stat.st_size))
+
+            self._entries = {key: [size, used] for used, key, size in sorted(files)}
+            self._total = sum(size for size, _ in self._entries.values())
+
+        return self._entries
+
+    def _track(self, key, size=None):
+        # Marks the entry as used just now, with its new size if it was written
+        with self._lock:
+            entries = self._index()
+            old = entries.pop(key, None)
+
+            if size is None:
+                if old is None:
+                    return
+                size = old[0]
+
+            self._total += size - (old[0] if old is not None else 0)
+            entries[key] = [size, time.time()]
+
+    def _untrack(self, key):
+        with self._lock:
+            old = self._index().pop(key, None)
+
+            if old is not None:
+                self._total -= old[0]
+
+    def get(self, key):
+        # Returns the entry for the key or None. Reading an entry marks it as recently used.
+        file = self._file(key)
+
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self.remove(key)
+            return None
+
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+
+        self._track(key)
+
+        return entry
+
+    def put(self, key, appointments, modified=None):
+        # Stores the appointments with the highest lastModified value, used for revalidation
+        if modified is None:
+            modified = max((a.get('lastModified', 0) for a in appointments), default=None)
+
+        entry = {
+            'fetched': time.time(),
+            'modified': modified,
+            'appointments': appointments
+        }
+
+        file = self._file(key)
+        # Per thread, so concurrent writes of the same entry don't share a temp file
+        temp_file = file.with_suffix(f'.{threading.get_ident()}.tmp')
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            data = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+
+            os.replace(temp_file, file)
+        except OSError as e:
+            self.logger.warning(f"Could not write cache entry {key}: {e}")
+            return entry
+
+        self._track(key, len(data))
+        self.evict()
+
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.get('fetched', 0) < self.max_age
+
+    def remove(self, key):
+        try:
+            self._file(key).unlink()
+        except FileNotFoundError:
+            pass
+
+        self._untrack(key)
+
+    def size(self):
+        with self._lock:
+            self._index()
+            return self._total
+
+    def evict(self):
+        # Removes the least recently used entries until the cache fits in max_bytes
+        with self._lock:
+            entries = self._index()
+
+            if self._total <= self.max_bytes:
+                return
+
+            for key, (size, _) in list(entries.items()):
+                if self._total <= self.max_bytes:
+                    break
+
+                try:
+                    self._file(key).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.warning(f"Could not evict cache entry {key}: {e}")
+                    continue
+
+                del entries[key]
+                self._total -= size
+                self.logger.debug(f"Evicted cache entry {key}")
+
+    def clear(self):
+        with self._lock:
+            for file in self.path.glob('*.json'):
+                try:
+                    file.unlink()
+                except FileNotFoundError:
+                    pass
+
+            self._entries = {}
+            self._total = 0
+
+
+class HorizonStore:
+    # Largest amount of weeks of appointments each instance allows per school year.
+    # Persisted as a json file when a path is given, else kept in memory only.
+
+    def __init__(self, path=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = Path(path) if path is not None else None
+        self._horizons = self._load()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(instance_id, school_year):
+        return f"{instance_id}/{school_year}"
+
+    def _load(self):
+        if self.path is None:
+            return {}
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Could not read horizons from {self.path}: {e}")
+            return {}
+
+    def get(self, instance_id, school_year):
+        return self._horizons.get(self._key(instance_id, school_year))
+
+    def set(self, instance_id, school_year, weeks):
+        with self._lock:
+            self._horizons[self._key(instance_id, school_year)] = weeks
+
+            if self.path is None:
+                return
+
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump(self._horizons, f)
+            except OSError as e:
+                self.logger.warning(f"Could not write horizons to {self.path}: {e}")
+
+
+class DirectoryStore:
+    # Account directories (the teachers and students of an instance) per school year, stored as one json file each.
+    # The last known directory is kept in memory, so storing an unchanged directory is a list comparison, not a write.
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = Path(path)
+        self._directories = {}
+
+    def _file(self, instance_id, school_year):
+        return self.path / f"{instance_id}-{school_year}.json"
+
+    def get(self, instance_id, school_year):
+        # Returns the stored accounts or None
+        key = (instance_id, school_year)
+
+        if key in self._directories:
+            return self._directories[key]
+
+        try:
+            with open(self._file(instance_id, school_year), 'r', encoding='utf-8') as f:
+                accounts = json.load(f).get('accounts')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, AttributeError) as e:
+            self.logger.warning(f"Could not read directory of {instance_id} in {school_year}: {e}")
+            return None
+
+        self._directories[key] = accounts
+
+        return accounts
+
+    def put(self, instance_id, school_year, accounts):
+        # Stores the accounts, returns whether they changed since they were last stored
+        accounts = list(accounts)
+
+        if self.get(instance_id, school_year) == accounts:
+            return False
+
+        self._directories[(instance_id, school_year)] = accounts
+
+        file = self._file(instance_id, school_year)
+        temp_file = file.with_suffix(f'.{threading.get_ident()}.tmp')
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({'fetched': time.time(), 'accounts': accounts}, f, separators=(',', ':'))
+
+            os.replace(temp_file, file)
+        except OSError as e:
+            self.logger.warning(f"Could not write directory of {instance_id} in {school_year}: {e}")
+
+        return True
+
+    def clear(self):
+        self._directories = {}
+
+        for file in self.path.glob('*.json'):
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
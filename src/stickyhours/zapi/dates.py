@@ -0,0 +1,13 @@
+from datetime import datetime
+
+# Time zone of the instances, used for dates and school years
+DEFAULT_TIMEZONE = 'Europe/Amsterdam'
+
+
+def get_school_year(date = None):
+    if date is None:
+        date = datetime.now()
+    if date.month < 8:
+        return date.year - 1
+    else:
+        return date.year
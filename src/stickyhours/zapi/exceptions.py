@@ -40,3 +40,18 @@ class ZermeloApiHttpStatusException(ZermeloException):
 
     def __str__(self):
         return f"{self.message}\nHttp code: {self.status}\nBody: {self.response}"
+
+
+class ZermeloCircuitOpenError(ZermeloApiNetworkError):
+    def __init__(self, instance_id, retry_in):
+        super().__init__(f"Too many failed requests to {instance_id}, not sending requests for {retry_in:.0f} seconds.")
+
+        self.instance_id = instance_id
+        self.retry_in = retry_in
+
+
+class ZermeloPoolFullError(ZermeloException):
+    def __init__(self, max_clients):
+        super().__init__(f"All {max_clients} clients of the pool are in use.")
+
+        self.max_clients = max_clients
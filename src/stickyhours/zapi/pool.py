@@ -0,0 +1,229 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from stickyhours.zapi.exceptions import *
+from stickyhours.zapi.resilience import RateLimiter
+from stickyhours.zapi.zermelo import Zermelo, validate_instance
+
+# Default maximum amount of clients open at once
+DEFAULT_MAX_CLIENTS = 32
+
+# Default maximum amount of pooled connections of all clients together
+DEFAULT_MAX_CONNECTIONS = 64
+
+# Default seconds after which an unused client is closed
+DEFAULT_IDLE_TIMEOUT = 5 * 60
+
+
+class _Entry:
+    __slots__ = ('client', 'in_use', 'last_used', 'closing')
+
+    def __init__(self, client):
+        self.client = client
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        # Removed from the pool while in use, closed when the last user releases it
+        self.closing = False
+
+
+class ZermeloPool:
+    # Authenticated clients of many instances in one process. Every instance gets its own Zermelo, with its own
+    # session, token, settings, circuit breaker and rate limit, so one school logging out or failing does not
+    # affect the others. At most max_clients clients are open at once, sharing max_connections connections.
+    # Idle clients are closed and created again from the stored token on their next use, so memory and sockets
+    # grow with the schools in use at the same time instead of with all schools served.
+
+    def __init__(self, max_clients=DEFAULT_MAX_CLIENTS, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, rate=None, burst=None, **client_kwargs):
+        self.logger = logging.getLogger(__name__)
+
+        self.max_clients = max_clients
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # Requests per second per instance, unlimited if None
+        self.rate = rate
+        self.burst = burst
+
+        # Passed to every client, a shared AppointmentCache or HorizonStore is keyed by instance already.
+        # The connections of a client follow from the limits of the pool instead.
+        for key in ('pool_size', 'pool_block'):
+            if key in client_kwargs:
+                raise ZermeloValueError(f"{key} is set by the pool, use max_connections and max_clients instead")
+
+        self.client_kwargs = client_kwargs
+
+        self._lock = threading.Lock()
+        self._tokens = {}
+        # Kept when a client is closed, so a recreated client does not get a fresh burst
+        self._limiters = {}
+        # Open clients, least recently used first
+        self._clients = OrderedDict()
+
+    @property
+    def pool_size(self):
+        # Connections per client, so all clients together stay within max_connections. Every client gets at least
+        # one, so with fewer connections than clients the limit is max_clients instead.
+        return max(1, self.max_connections // self.max_clients)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tokens)
+
+    def __contains__(self, instance_id):
+        with self._lock:
+            return instance_id in self._tokens
+
+    def instances(self):
+        with self._lock:
+            return list(self._tokens)
+
+    def open_clients(self):
+        with self._lock:
+            return list(self._clients)
+
+    def add(self, instance_id, token, check=True):
+        # Adds or replaces the token of an instance. Raises ZermeloAuthException if the token is checked and invalid.
+        instance_id = instance_id.strip()
+        validate_instance(instance_id)
+
+        with self._lock:
+            self._tokens[instance_id] = token
+
+            if self.rate is not None and instance_id not in self._limiters:
+                self._limiters[instance_id] = RateLimiter(self.rate, self.burst)
+
+            # A client of the previous token is not used anymore
+            self._close(instance_id)
+
+        if not check:
+            return
+
+        try:
+            with self.client(instance_id) as zermelo:
+                valid = zermelo.check_token(token, instance_id)
+        except ZermeloAuthException:
+            valid = False
+
+        if not valid:
+            self.remove(instance_id)
+            raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
+
+    def remove(self, instance_id, logout=False):
+        # Forgets the instance, with logout its token is logged out first
+        if logout and instance_id in self:
+            with self.client(instance_id) as zermelo:
+                zermelo.logout()
+
+        with self._lock:
+            self._tokens.pop(instance_id, None)
+            self._limiters.pop(instance_id, None)
+            self._close(instance_id)
+
+    @contextmanager
+    def client(self, instance_id):
+        # The logged in client of the instance, not evicted while in use. A rejected token removes the instance.
+        entry = self._checkout(instance_id)
+
+        try:
+            yield entry.client
+        except ZermeloAuthException:
+            if not entry.client.logged_in:
+                self.logger.info(f"Session of {instance_id} expired, removing it from the pool")
+                self.remove(instance_id)
+            raise
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+                if entry.closing and not entry.in_use:
+                    self._close_client(instance_id, entry)
+
+    def evict_idle(self):
+        # Closes the clients unused for idle_timeout seconds, returns how many were closed
+        with self._lock:
+            return self._evict_idle()
+
+    def close(self):
+        # Closes all clients, the tokens are kept
+        with self._lock:
+            for instance_id in list(self._clients):
+                self._close(instance_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _checkout(self, instance_id):
+        with self._lock:
+            token = self._tokens.get(instance_id)
+
+            if token is None:
+                raise ZermeloAuthException(f"Not logged in to {instance_id}")
+
+            self._evict_idle()
+
+            entry = self._clients.get(instance_id)
+
+            if entry is None:
+                self._make_room()
+                entry = self._clients[instance_id] = _Entry(self._create(instance_id, token))
+
+            self._clients.move_to_end(instance_id)
+            entry.in_use += 1
+
+            return entry
+
+    def _create(self, instance_id, token):
+        self.logger.debug(f"Opening client for {instance_id}")
+
+        # Blocking, so a client never opens more than its share of the connections
+        zermelo = Zermelo(pool_size=self.pool_size, pool_block=True, **self.client_kwargs)
+        zermelo.rate_limiter = self._limiters.get(instance_id)
+
+        # Checked when added, no request is sent here
+        zermelo.token_login(token, instance_id, check=False)
+
+        return zermelo
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        idle = [instance_id for instance_id, entry in self._clients.items()
+                if not entry.in_use and now - entry.last_used >= self.idle_timeout]
+
+        for instance_id in idle:
+            self._close(instance_id)
+
+        return len(idle)
+
+    def _make_room(self):
+        # Closes the least recently used idle clients until another client fits
+        while len(self._clients) >= self.max_clients:
+            instance_id = next((i for i, entry in self._clients.items() if not entry.in_use), None)
+
+            if instance_id is None:
+                raise ZermeloPoolFullError(self.max_clients)
+
+            self._close(instance_id)
+
+    def _close(self, instance_id):
+        # A client in use is closed once released, closing its session now would break the requests in flight
+        entry = self._clients.pop(instance_id, None)
+
+        if entry is None:
+            return
+
+        if entry.in_use:
+            entry.closing = True
+        else:
+            self._close_client(instance_id, entry)
+
+    def _close_client(self, instance_id, entry):
+        self.logger.debug(f"Closing client for {instance_id}")
+        entry.client.close_session()
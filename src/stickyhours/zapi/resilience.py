@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from stickyhours.zapi.exceptions import ZermeloCircuitOpenError
+
+# Statuses worth retrying: rate limited, or a server or gateway error that is likely temporary
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Only requests that are safe to send twice are retried
+RETRY_METHODS = frozenset({'GET', 'PUT', 'DELETE'})
+
+
+def parse_retry_after(value, now=None):
+    # Seconds to wait from a Retry-After header, which holds seconds or an http date. None if missing or invalid.
+    if not value:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        return float(value)
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+
+    now = now if now is not None else datetime.now(timezone.utc)
+
+    return max(0.0, (date - now).total_seconds())
+
+
+class RetryPolicy:
+    # Bounded retries with exponential backoff and full jitter. A request is attempted at most max_attempts times
+    # and no retry is started that would wait past max_elapsed seconds since the first attempt. The timeout of a
+    # retry is shortened to the time left, so a request with its retries ends within its first timeout or
+    # max_elapsed seconds, whichever is longer.
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=8.0, max_elapsed=10.0, statuses=RETRY_STATUSES,
+                 methods=RETRY_METHODS, rng=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        self.statuses = statuses
+        self.methods = methods
+
+        self.rng = rng if rng is not None else random.Random()
+
+    def retryable(self, method, status=None):
+        # A network error (no status) or a retryable status of an idempotent request
+        return method.upper() in self.methods and (status is None or status in self.statuses)
+
+    def next_delay(self, attempt, started, retry_after=None):
+        # Seconds to wait before the next attempt, or None when the request should not be retried.
+        # Attempt counts from 0, started is the time.monotonic() of the first attempt.
+        if attempt + 1 >= self.max_attempts:
+            return None
+
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = self.rng.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+        if time.monotonic() - started + delay > self.max_elapsed:
+            return None
+
+        return delay
+
+
+    def attempt_timeout(self, timeout, started):
+        # The timeout of a retry, a (connect, read) tuple or seconds like the timeout of the first attempt, shortened
+        # so it does not wait past max_elapsed seconds since the first attempt
+        left = max(0.0, self.max_elapsed - (time.monotonic() - started))
+
+        if isinstance(timeout, tuple):
+            return tuple(left if t is None else min(t, left) for t in timeout)
+
+        return left if timeout is None else min(timeout, left)
+
+
+class CircuitBreaker:
+    # Stops sending requests to an instance after failure_threshold consecutive failures. After reset_timeout
+    # seconds one trial request is let through, its success closes the circuit and its failure opens it again.
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            if time.monotonic() - self._opened >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_request(self):
+        # Raises ZermeloCircuitOpenError while the circuit is open
+        with self._lock:
+            if self._opened is None:
+                return
+
+            waited = time.monotonic() - self._opened
+
+            if waited >= self.reset_timeout and not self._trial:
+                self._trial = True
+                return
+
+        raise ZermeloCircuitOpenError(self.name, max(0.0, self.reset_timeout - waited))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened = time.monotonic()
+                self._trial = False
+
+
+class RateLimiter:
+    # Token bucket allowing rate requests per second on average, in bursts of at most burst requests
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def reserve(self):
+        # Takes a token, returns the seconds to wait before it may be used
+        with self._lock:
+            now = time.monotonic()
+
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        delay = self.reserve()
+
+        if delay:
+            time.sleep(delay)
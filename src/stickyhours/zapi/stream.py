@@ -0,0 +1,119 @@
+import json
+from json.decoder import scanstring
+
+from stickyhours.zapi.exceptions import ZermeloApiDataException
+
+_WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+
+def iter_response_data(chunks, key='data'):
+    # Incrementally parses a zermelo response ({"response": {..., "data": [...]}}) from text chunks
+    # and yields the items of the data array one at a time, without keeping the whole body in memory.
+    buffer = ''
+    position = 0
+    depth = 0
+    last_key = None
+    in_array = False
+
+    chunks = iter(chunks)
+
+    def read():
+        # Appends the next chunk to the buffer and drops the part that is already parsed
+        nonlocal buffer, position
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ZermeloApiDataException('Response ended before the data array was complete.')
+
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    # Find the data array of the response object
+    while not in_array:
+        if position >= len(buffer):
+            read()
+            continue
+
+        char = buffer[position]
+
+        if char == '"':
+            try:
+                string, end = scanstring(buffer, position + 1)
+            except json.JSONDecodeError:
+                # The string is split over chunks
+                read()
+                continue
+
+            last_key = string
+            position = end
+            continue
+
+        if char in '{[':
+            if char == '[' and depth == 2 and last_key == key:
+                in_array = True
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                # Done without finding the data array
+                return
+        elif char == ',':
+            last_key = None
+
+        position += 1
+
+    # Decode the items of the data array one by one
+    while True:
+        while position < len(buffer) and buffer[position] in _WHITESPACE + ',':
+            position += 1
+
+        if position >= len(buffer):
+            read()
+            continue
+
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item is split over chunks
+            read()
+            continue
+
+        position = end
+
+        yield item
+
+
+class ResponseItems:
+    # Iterator over the items of a streamed response, which holds a pooled connection until the body is read.
+    # The connection is released when the items are exhausted or when closed, also if they were never iterated,
+    # where closing a generator that did not start does not run its cleanup. Use it in a with block or close it
+    # when not reading all items.
+
+    def __init__(self, response, items):
+        self._response = response
+        self._items = items
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def close(self):
+        self._items.close()
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        # Last resort, so an abandoned iterator does not keep a connection of a blocking pool
+        self.close()
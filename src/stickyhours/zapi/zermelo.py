@@ -1,13 +1,40 @@
 import json
 import logging
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from urllib.parse import urlparse, parse_qs
 
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
 
+from stickyhours.tracing import tracer
+from stickyhours.zapi.cache import HorizonStore
+from stickyhours.zapi.dates import DEFAULT_TIMEZONE, get_school_year
 from stickyhours.zapi.exceptions import *
+from stickyhours.zapi.resilience import CircuitBreaker, RetryPolicy, parse_retry_after
+from stickyhours.zapi.stream import ResponseItems, iter_response_data
+
+# Default amount of keep-alive connections kept open per instance
+DEFAULT_POOL_SIZE = 10
+
+# Default (connect, read) timeout in seconds for a single request
+DEFAULT_TIMEOUT = (5, 20)
+
+# Url of the api of an instance, can be overridden to use another server, like a local stand-in for testing
+DEFAULT_BASE_URL = 'https://{instance_id}.zportal.nl/api/v{api_version}'
+
+# Tokens expiring within this amount of seconds are not used anymore
+MIN_TOKEN_SECONDS_LEFT = 60 * 60
+
+# Appointment fields requested when the caller does not pick them
+DEFAULT_APPOINTMENT_FIELDS = 'groups,start,end,startTimeSlot,endTimeSlot,teachers'
+
+# Size in bytes of the chunks a streamed response is parsed in
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 def validate_instance(instance_id):
@@ -21,21 +48,190 @@ def validate_instance(instance_id):
         raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
 
 
-def get_school_year(date = None):
-    if date is None:
-        date = datetime.now()
-    if date.month < 8:
-        return date.year - 1
-    else:
-        return date.year
+def is_forbidden(exception):
+    # Checks if a data exception was caused by a 403 (forbidden) response
+    return '403' in str(exception)
+
+
+def split_weeks(start: datetime, end: datetime):
+    # Splits a date range into week aligned (monday to sunday) chunks, the first and last chunk are clipped to the range
+    week_start = start.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=start.weekday())
+
+    chunks = []
+
+    while week_start <= end:
+        week_end = week_start + timedelta(days=6, hours=23, minutes=59, seconds=59)
+        chunks.append((max(week_start, start), min(week_end, end)))
+
+        week_start += timedelta(days=7)
+
+    return chunks
+
+
+def sync_params(params, modified):
+    # Params requesting the appointments of the range modified since the high-water mark, including the cancelled
+    # and invalidated ones, because those have to be removed from a cached entry
+    fields = params['fields'].split(',') + ['id', 'lastModified', 'valid', 'cancelled']
+
+    return {
+        'start': params['start'],
+        'end': params['end'],
+        'user': params['user'],
+        'fields': ",".join(dict.fromkeys(fields)),
+        'modifiedSince': modified + 1
+    }
+
+
+def merge_appointments(appointments, changes, modified, valid_only):
+    # Merges modified appointments into cached ones by id. Returns the merged appointments and the new high-water mark.
+    if not changes:
+        return appointments, modified
+
+    merged = {appointment.get('id'): appointment for appointment in appointments}
+
+    for change in changes:
+        if valid_only and (change.get('cancelled') or not change.get('valid')):
+            merged.pop(change.get('id'), None)
+        else:
+            merged[change.get('id')] = change
+
+        modified = max(modified, change.get('lastModified', modified))
+
+    return sorted(merged.values(), key=lambda a: a.get('start', 0)), modified
+
+
+def cache_fields(fields):
+    # The fields requested for a cached entry, the id and lastModified fields are needed to revalidate it later
+    return ",".join(dict.fromkeys(fields.split(',') + ['id', 'lastModified']))
+
+
+def current_week_start(now=None):
+    # Midnight of the monday of the current week
+    now = now if now is not None else datetime.now()
+
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=now.weekday())
+
+
+def weeks_end(start, weeks):
+    # The last second of the amount of weeks from the week start
+    return start + timedelta(days=6 + 7 * (weeks - 1), hours=23, minutes=59, seconds=59)
+
+
+class HorizonSearch:
+    # The appointment horizon probing of get_current_weeks_appointments, shared by Zermelo and AsyncZermelo which
+    # only differ in how they fetch. Weeks is the amount to fetch first, capped at the known horizon. When that is
+    # forbidden (403), next_weeks gives the amounts to try until it returns None, every outcome is reported with
+    # allow or forbid, and result gives the appointments of the largest allowed amount.
+
+    def __init__(self, horizons, instance_id, school_year, weeks, use_horizon=True):
+        self.horizons = horizons
+        self.instance_id = instance_id
+        self.school_year = school_year
+
+        horizon = horizons.get(instance_id, school_year) if use_horizon else None
+        self.weeks = horizon if horizon is not None and horizon < weeks else weeks
+
+        self.allowed = 0
+        self.forbidden = self.weeks
+        self.appointments = None
+
+    def next_weeks(self):
+        # Binary search the largest allowed amount of weeks below the forbidden amount
+        if self.forbidden - self.allowed <= 1:
+            return None
+
+        return (self.allowed + self.forbidden) // 2
+
+    def allow(self, weeks, appointments):
+        self.allowed = weeks
+        self.appointments = appointments
+
+    def forbid(self, weeks):
+        self.forbidden = weeks
+
+    def result(self, error):
+        # The appointments of the largest allowed amount of weeks, which is remembered per instance and school year.
+        # Raises error when not even one week is allowed.
+        if self.allowed == 0:
+            raise error
+
+        self.horizons.set(self.instance_id, self.school_year, self.allowed)
+
+        return self.appointments
+
+
+class SingleFlight:
+    # Coalesces concurrent calls with the same key. The first caller runs the function,
+    # callers arriving while it runs wait for its result or exception instead of running it again.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
 
 
 class Zermelo:
+    # Safe to use from several threads at once, the app fetches from executor threads
 
-    def __init__(self, api_version=3):
+    def __init__(self, api_version=3, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, cache=None,
+                 incremental_sync=True, horizons=None, timezone=DEFAULT_TIMEZONE, base_url=DEFAULT_BASE_URL, retry=None,
+                 breaker_threshold=5, breaker_reset=30.0, pool_block=False):
         self.logger = logging.getLogger(__name__)
 
         self.api_version = api_version
+        self.base_url = base_url
+        self.timezone = timezone
+
+        # Connection pooling, one keep-alive session per instance
+        self.pool_size = pool_size
+        # Wait for a free pooled connection instead of opening one beyond pool_size
+        self.pool_block = pool_block
+        self.timeout = timeout
+        self._session = None
+        self._session_instance_id = None
+
+        # Optional AppointmentCache for get_appointments
+        self.cache = cache
+
+        # Refresh stale cache entries with only the appointments modified since the entry was stored
+        self.incremental_sync = incremental_sync
+
+        # Largest allowed amount of appointment weeks per instance and school year
+        self.horizons = horizons if horizons is not None else HorizonStore()
+
+        # Retries of failed requests, and a circuit breaker per instance to stop hammering one that is down
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._breakers = {}
+
+        # Optional RateLimiter every request attempt waits for
+        self.rate_limiter = None
 
         self.logger.info(f"Instance created with api version {api_version}")
 
@@ -45,7 +241,57 @@ class Zermelo:
 
         self._settings = {}
         self._user = None
-        self.max_appointment_weeks = 52
+
+        # Guards the session and the login state
+        self._lock = threading.RLock()
+
+        # Concurrent user and settings lookups share one request
+        self._flight = SingleFlight()
+
+    def get_url(self, instance_id, endpoint):
+        return f'{self.base_url.format(instance_id=instance_id, api_version=self.api_version)}/{endpoint.strip()}'
+
+    def get_session(self, instance_id):
+        # Returns the pooled keep-alive session for the instance, a session of another instance gets closed
+        with self._lock:
+            if self._session is not None and self._session_instance_id == instance_id:
+                return self._session
+
+            self.close_session()
+
+            self.logger.debug(f"Opening session for {instance_id} with pool size {self.pool_size}")
+
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=self.pool_block)
+
+            self._session = requests.Session()
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._session_instance_id = instance_id
+
+            return self._session
+
+    def get_breaker(self, instance_id):
+        # Returns the circuit breaker of the instance
+        with self._lock:
+            breaker = self._breakers.get(instance_id)
+
+            if breaker is None:
+                breaker = self._breakers[instance_id] = CircuitBreaker(instance_id, self.breaker_threshold,
+                                                                       self.breaker_reset)
+
+            return breaker
+
+    def close_session(self):
+        # Closes the pooled connections of the current session
+        with self._lock:
+            if self._session is None:
+                return
+
+            self.logger.debug(f"Closing session for {self._session_instance_id}")
+
+            self._session.close()
+            self._session = None
+            self._session_instance_id = None
 
     def require_setting(self, setting, value, endpoint=None, school_year=None):
         if not self.logged_in:
@@ -67,6 +313,9 @@ class Zermelo:
         if self._user:
             return self._user
 
+        return self._flight.do('user', self._request_user)
+
+    def _request_user(self):
         self._user = self.send_request('GET', 'users/~me').get('data')[0]
 
         return self._user
@@ -82,6 +331,9 @@ class Zermelo:
         if self._settings.get(school_year):
             return self._settings.get(school_year)
 
+        return self._flight.do(('settings', school_year), lambda: self._request_settings(school_year))
+
+    def _request_settings(self, school_year):
         SISYs = self.get_user().get('schoolInSchoolYears')
         self.logger.info(f"SchoolInSchoolYears: {SISYs}")
 
@@ -99,10 +351,12 @@ class Zermelo:
         except IndexError:
             raise ZermeloApiDataException('No response data in settings request.')
 
-        return d.get('data')[0]
+        return self._settings[school_year]
 
-    def get_appointments(self, start: float, end: float, fields: str, user: str, is_teacher: bool = False, valid_only: bool = True):
-        # Gets the raw schedule from the api
+    def get_appointments(self, start: float, end: float, fields: str, user: str, is_teacher: bool = False, valid_only: bool = True,
+                         stream: bool = False):
+        # Gets the raw schedule from the api. With stream the appointments are yielded while the response is
+        # downloaded, streamed requests bypass the cache.
 
         self.logger.info("method get_appointments called")
 
@@ -110,7 +364,7 @@ class Zermelo:
             raise ZermeloAuthException('Not logged in')
 
         self.require_setting(f"{'student' if self.get_user().get('isStudent') else 'employee'}CanViewProjectSchedules",
-                             True, 'appointments', get_school_year(datetime.fromtimestamp(start, tz=pytz.timezone('Europe/Amsterdam'))))
+                             True, 'appointments', get_school_year(datetime.fromtimestamp(start, tz=pytz.timezone(self.timezone))))
 
         params = {
             'start': int(start),
@@ -123,8 +377,68 @@ class Zermelo:
             params['valid'] = True
             params['cancelled'] = False
 
+        if stream:
+            return self._request_appointments(params, stream=True)
+
+        if self.cache is None:
+            return self._request_appointments(params)
+
+        key = self.cache.key(self.instance_id, user, start, end, fields, valid_only)
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                self.logger.info("Serving appointments of %s from cache", user)
+                return entry.get('appointments')
+
+            if self.incremental_sync and entry.get('modified') is not None:
+                appointments, modified = self._sync_appointments(params, entry, valid_only)
+                self.logger.info("Synced cached appointments of %s", user)
+                return self.cache.put(key, appointments, modified).get('appointments')
+
+            if not self._appointments_modified(params, entry.get('modified')):
+                self.logger.info("Revalidated cached appointments of %s", user)
+                return self.cache.put(key, entry.get('appointments'), entry.get('modified')).get('appointments')
+
+        params['fields'] = cache_fields(fields)
+
+        appointments = self._request_appointments(params)
+
+        if appointments is not None:
+            self.cache.put(key, appointments)
+
+        return appointments
+
+    def _appointments_modified(self, params, modified):
+        # Checks if any appointment in the range changed since the cached lastModified value
+        if modified is None:
+            return True
+
+        params = {
+            'start': params['start'],
+            'end': params['end'],
+            'user': params['user'],
+            'fields': 'id',
+            'modifiedSince': modified + 1
+        }
+
+        return len(self._request_appointments(params) or []) > 0
+
+    def _sync_appointments(self, params, entry, valid_only):
+        # Fetches the appointments modified since the high-water mark of the entry and merges them into it.
+        # Returns the merged appointments and the new high-water mark.
+        modified = entry.get('modified')
+
+        changes = self._request_appointments(sync_params(params, modified)) or []
+
+        if changes:
+            self.logger.debug("Merging %d modified appointments", len(changes))
+
+        return merge_appointments(entry.get('appointments'), changes, modified, valid_only)
+
+    def _request_appointments(self, params, stream=False):
         try:
-            d = self.send_request('GET', 'appointments', params=params)
+            appointments = self.send_request('GET', 'appointments', params=params, stream=True)
         except ZermeloApiHttpStatusException as e:
             # Not allowed to search for value, possibly due to summer holidays?
             if e.status == 403:
@@ -132,53 +446,119 @@ class Zermelo:
                     'No response data in appointments request due to 403 (forbidden). Check if you can access the schedules in the zermelo portal.')
             raise e
 
-        try:
-            return d.get('data')
-        except AttributeError:
-            raise ZermeloApiDataException('No response data in appointments request.')
+        if stream:
+            return appointments
+
+        return list(appointments)
 
     def get_current_weeks_appointments(self, user: str, is_teacher: bool = False, weeks: int = 1,
-                                       valid_only: bool = False, fix_403: bool = True, fields='groups,start,end,startTimeSlot,endTimeSlot,teachers',
-                                       max_weeks_optimization: bool = True, max_weeks_optimization_original_weeks: int = None):
+                                       valid_only: bool = False, fix_403: bool = True, fields=DEFAULT_APPOINTMENT_FIELDS,
+                                       max_weeks_optimization: bool = True):
+        # The appointments of the current week and the following weeks. If the instance forbids the range (403),
+        # the largest allowed amount of weeks is probed and remembered per instance and school year.
         self.logger.info("method get_current_weeks_appointments called")
 
-        if max_weeks_optimization_original_weeks is None:
-            max_weeks_optimization_original_weeks = weeks
-
-        # The appointments of the current week
         if not self.logged_in:
             raise ZermeloAuthException('Not logged in')
 
+        school_year = get_school_year(datetime.now())
+
         self.require_setting(f"{'student' if self.get_user().get('isStudent') else 'employee'}CanViewProjectSchedules",
-                             True, 'appointments', get_school_year(datetime.now()))
+                             True, 'appointments', school_year)
 
-        now = datetime.now()
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=now.weekday())
-        end = start + timedelta(days=6 + 7 * (weeks - 1), hours=23, minutes=59, seconds=59)
+        start = current_week_start()
 
-        try:
-            appointments = self.get_appointments(start.timestamp(), end.timestamp(), fields, user, is_teacher, valid_only)
+        def fetch(weeks_amount):
+            end = weeks_end(start, weeks_amount)
+            return self.get_appointments(start.timestamp(), end.timestamp(), fields, user, is_teacher, valid_only)
 
-            if weeks != max_weeks_optimization_original_weeks:
-                self.max_appointment_weeks = weeks
+        if not fix_403:
+            return fetch(weeks)
 
-            return appointments
+        search = HorizonSearch(self.horizons, self.instance_id, school_year, weeks, max_weeks_optimization)
+
+        try:
+            return fetch(search.weeks)
         except ZermeloApiDataException as e:
+            if not is_forbidden(e) or search.weeks <= 1:
+                raise e
 
-            if fix_403 and '403' in str(e) and weeks > 1:
+            error = e
 
-                if max_weeks_optimization:
-                    weeks = min(weeks - 1, self.max_appointment_weeks)
-                else:
-                    weeks -= 1
+        self.logger.info(f"Probing the appointment horizon below {search.weeks} weeks")
 
-                return self.get_current_weeks_appointments(user, is_teacher, weeks, valid_only, True, fields,
-                                                           max_weeks_optimization, max_weeks_optimization_original_weeks)
-            else:
-                raise e
+        while True:
+            middle = search.next_weeks()
+            if middle is None:
+                break
+
+            try:
+                search.allow(middle, fetch(middle))
+            except ZermeloApiDataException as e:
+                if not is_forbidden(e):
+                    raise e
+                search.forbid(middle)
+
+        appointments = search.result(error)
+        self.logger.info(f"Appointment horizon of {self.instance_id} in {school_year} is {search.allowed} weeks")
 
-    def get_students(self, school_year: int = None, fields: str = None):
+        return appointments
+
+    def iter_appointments(self, start: datetime, end: datetime, user: str, is_teacher: bool = False,
+                          valid_only: bool = False, fields=DEFAULT_APPOINTMENT_FIELDS,
+                          max_workers: int = 4, skip_forbidden: bool = True):
+        # Fetches a date range in week chunks concurrently and yields (chunk start, appointments) per week as soon as
+        # it arrives, so weeks may be yielded out of order. At most max_workers weeks are in flight at once.
+        # Weeks are independent for the gap computation, so processing can start before the whole range is fetched.
+        self.logger.info("method iter_appointments called")
+
+        if not self.logged_in:
+            raise ZermeloAuthException('Not logged in')
+
+        # Checked up front, so the settings are not requested by every worker at once
+        self.require_setting(f"{'student' if self.get_user().get('isStudent') else 'employee'}CanViewProjectSchedules",
+                             True, 'appointments', get_school_year(start))
+
+        chunks = iter(split_weeks(start, end))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+
+            def submit_next():
+                for week_start, week_end in chunks:
+                    future = executor.submit(self.get_appointments, week_start.timestamp(), week_end.timestamp(),
+                                             fields, user, is_teacher, valid_only)
+                    pending[future] = week_start
+                    return
+
+            for _ in range(max_workers):
+                submit_next()
+
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        week_start = pending.pop(future)
+                        submit_next()
+
+                        try:
+                            appointments = future.result()
+                        except ZermeloApiDataException as e:
+                            if skip_forbidden and is_forbidden(e):
+                                self.logger.info(f"Skipping forbidden week of {week_start.date()} for {user}")
+                                continue
+                            raise e
+
+                        yield week_start, appointments
+            finally:
+                # Stopped early or failed, don't start the remaining weeks
+                for future in pending:
+                    future.cancel()
+
+    def get_students(self, school_year: int = None, fields: str = None, stream: bool = False):
         # gets the students. requires setting *CanViewProjectSchedules to work and studentCanViewProjectNames to view names as student
+        # with stream the students are yielded while the response is downloaded
         self.logger.info("method get_students called")
         if not self.logged_in:
             raise ZermeloAuthException('Not logged in')
@@ -194,16 +574,21 @@ class Zermelo:
             "fields": fields
         }
         try:
-            d = self.send_request('GET', 'users', params=params)
+            users = self.send_request('GET', 'users', params=params, stream=True)
         except ZermeloApiHttpStatusException as e:
             # Not allowed to search for value, possibly due to summer holidays?
             if e.status == 403:
                 raise ZermeloApiDataException(
                     'No response data in students request due to 403 (forbidden). Check if you can access the schedules in the zermelo portal.')
             raise e
-        return d.get('data')
 
-    def get_teachers(self, school_year: int = None, fields: str =None):
+        if stream:
+            return users
+
+        return list(users)
+
+    def get_teachers(self, school_year: int = None, fields: str =None, stream: bool = False):
+        # gets the teachers, with stream the teachers are yielded while the response is downloaded
         if not self.logged_in:
             raise ZermeloAuthException('Not logged in')
 
@@ -218,102 +603,197 @@ class Zermelo:
             "fields": fields
         }
         try:
-            d = self.send_request('GET', 'users', params=params)
+            users = self.send_request('GET', 'users', params=params, stream=True)
         except ZermeloApiHttpStatusException as e:
             # Not allowed to search for value, possibly due to summer holidays?
             if e.status == 403:
                 raise ZermeloApiDataException(
                     'No response data in students request due to 403 (forbidden). Check if you can access the schedules in the zermelo portal.')
             raise e
-        return d.get('data')
 
-    def send_request(self, method, endpoint, params={}, data={}, headers={}):
-        # Send requests, once logged in
+        if stream:
+            return users
+
+        return list(users)
+
+    def send_request(self, method, endpoint, params=None, data=None, headers=None, timeout=None, stream=False):
+        # Send requests, once logged in. With stream a ResponseItems of the items in the response data is returned,
+        # which parses the body while it is downloaded and must be exhausted or closed.
         self.logger.info("method send_request called")
 
-        url = f'https://{self.instance_id}.zportal.nl/api/v{self.api_version}/{endpoint.strip()}'
+        # Copied, the params of the caller are not modified
+        with self._lock:
+            instance_id = self.instance_id
+            params = {**(params or {}), 'access_token': self.token}
 
-        params['access_token'] = self.token
+            # Stop if not logged in
+            if not self.logged_in:
+                raise ZermeloAuthException('Not logged in')
 
-        # Stop if not logged in
-        if not self.logged_in:
-            raise ZermeloAuthException('Not logged in')
+        url = self.get_url(instance_id, endpoint)
+
+        data = {} if data is None else data
+        headers = {} if headers is None else headers
 
         # Sending the request
-        self.logger.info(f"Request: {method} {url}")
-        self.logger.debug(f"Request params: {params}")
-        self.logger.debug(f"Request data: {data}")
-        self.logger.debug(f"Request headers: {headers}")
+        self.logger.info("Request: %s %s", method, url)
+        self.logger.debug("Request params: %s", params)
+        self.logger.debug("Request data: %s", data)
+        self.logger.debug("Request headers: %s", headers)
 
-        # Choose request method
-        try:
+        session = self.get_session(instance_id)
 
-            if method.upper() == 'GET':
-                r = requests.get(url, params=params, headers=headers)
-            elif method.upper() == 'POST':
-                r = requests.post(url, params=params, json=data, headers=headers)
-            elif method.upper() == 'PUT':
-                r = requests.put(url, params=params, json=data, headers=headers)
-            elif method.upper() == 'DELETE':
-                r = requests.delete(url, params=params, headers=headers)
+        if timeout is None:
+            timeout = self.timeout
 
-        except requests.exceptions.ConnectionError:
-            raise ZermeloApiNetworkError("Could not reach the zermelo servers")
+        breaker = self.get_breaker(instance_id)
+        started = time.monotonic()
+        attempt = 0
+
+        # Retried while the policy allows it, an open circuit fails at once without sending anything
+        while True:
+            breaker.before_request()
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                r = self._send(session, method, url, params, data, headers,
+                               self.retry.attempt_timeout(timeout, started) if attempt else timeout, stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                breaker.record_failure()
+
+                delay = self.retry.next_delay(attempt, started) if self.retry.retryable(method) else None
+                if delay is None:
+                    raise ZermeloApiNetworkError("Could not reach the zermelo servers")
+
+                self.logger.warning("Could not reach %s, retrying in %.2f seconds", url, delay)
+            except BaseException:
+                # Any other error ends the request as well, an unrecorded trial request would keep the circuit open
+                breaker.record_failure()
+                raise
+            else:
+                # Only server errors count as failures of the instance, a rate limit means it is up
+                if r.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+
+                delay = None
+                if self.retry.retryable(method, r.status_code):
+                    delay = self.retry.next_delay(attempt, started, parse_retry_after(r.headers.get('Retry-After')))
+
+                if delay is None:
+                    break
+
+                self.logger.warning("Request returned %s, retrying in %.2f seconds", r.status_code, delay)
+                r.close()
+
+            time.sleep(delay)
+            attempt += 1
 
-        self.logger.info(f"Request response: {r}")
-        self.logger.debug(f"Response url: {r.url}")
+        self.logger.info("Request response: %s", r)
+        self.logger.debug("Response url: %s", r.url)
         # self.logger.debug(f"Request body: {r.text}")
 
+        # A streamed body is counted while it is parsed
+        if tracer.enabled and (not stream or r.status_code >= 400):
+            tracer.record_request(endpoint, r.status_code, len(r.content), r.elapsed.total_seconds())
+
         # Stop if request returned an http error code
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             if r.status_code == 401:
                 # Unauthorised, token is expired
-                self.token = None
-                self.instance_id = None
-                self.logged_in = False
+                with self._lock:
+                    self.token = None
+                    self.instance_id = None
+                    self.logged_in = False
 
                 raise ZermeloAuthException('Session expired')
             raise ZermeloApiHttpStatusException(r.status_code, r.text)
 
+        if stream:
+            return ResponseItems(r, self._iter_response_data(r, endpoint))
+
         # Return request data if exist
         try:
             return r.json().get('response')
         except json.decoder.JSONDecodeError:
             return r.text
 
-    def check_token(self, token, instance_id, min_seconds_left=60 * 60):
-        # Check if a token is valid
-        self.logger.info("method check_token called")
+    def _send(self, session, method, url, params, data, headers, timeout, stream):
+        # Choose request method
+        if method.upper() == 'GET':
+            return session.get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+        elif method.upper() == 'POST':
+            return session.post(url, params=params, json=data, headers=headers, timeout=timeout, stream=stream)
+        elif method.upper() == 'PUT':
+            return session.put(url, params=params, json=data, headers=headers, timeout=timeout, stream=stream)
+        elif method.upper() == 'DELETE':
+            return session.delete(url, params=params, headers=headers, timeout=timeout, stream=stream)
+
+        raise ZermeloValueError(f"Unsupported request method {method}")
+
+    def _iter_response_data(self, r, endpoint):
+        # Yields the items of the response data array while the body is downloaded
+        if r.encoding is None:
+            r.encoding = 'utf-8'
+
+        size = 0
+
+        def counted(chunks):
+            nonlocal size
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+
+        try:
+            yield from iter_response_data(counted(r.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True)))
+        except requests.exceptions.RequestException:
+            raise ZermeloApiNetworkError("Could not reach the zermelo servers")
+        finally:
+            r.close()
+            tracer.record_request(endpoint, r.status_code, size, r.elapsed.total_seconds())
 
+    def get_token_expires(self, token, instance_id):
+        # Returns the epoch the token expires at
         instance_id = instance_id.strip()
         validate_instance(instance_id)
 
         self.logger.debug(f"Validating token {token} on {instance_id}")
 
+        url = f'{self.get_url(instance_id, "tokens/~current")}?access_token={token}'
+
         try:
-            now_seconds = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
+            r = self.get_session(instance_id).get(url, allow_redirects=False, timeout=self.timeout)
+            tracer.record_request('tokens/~current', r.status_code, len(r.content), r.elapsed.total_seconds())
+            r.raise_for_status()
 
-            url = f'https://{instance_id}.zportal.nl/api/v{self.api_version}/tokens/~current?access_token={token}'
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            raise ZermeloApiNetworkError("Could not reach the zermelo servers")
 
-            try:
-                r = requests.get(url, allow_redirects=False)
-                r.raise_for_status()
-                expires_seconds = r.json().get('response').get('data')[0].get('expires')
+        except requests.exceptions.HTTPError:
+            if r.status_code == 404:
+                self.logger.error(f"Instance {instance_id} does not exist.")
+                raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
 
-            except requests.exceptions.ConnectionError:
-                raise ZermeloApiNetworkError("Could not reach the zermelo servers")
+            if r.status_code == 401:
+                raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
 
-            except requests.exceptions.HTTPError:
-                if r.status_code == 404:
-                    self.logger.error(f"Instance {instance_id} does not exist.")
-                    raise ZermeloValueError(f"Incorrect instance id: {instance_id}")
+            raise ZermeloApiHttpStatusException(r.status_code, r.text)
 
-                if r.status_code == 401:
-                    raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
+        return r.json().get('response').get('data')[0].get('expires')
 
-                raise ZermeloApiHttpStatusException(r.status_code, r.text)
+    def check_token(self, token, instance_id, min_seconds_left=MIN_TOKEN_SECONDS_LEFT):
+        # Check if a token is valid
+        self.logger.info("method check_token called")
+
+        try:
+            now_seconds = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
+
+            expires_seconds = self.get_token_expires(token, instance_id)
 
             if expires_seconds - now_seconds > min_seconds_left:
                 self.logger.info(f"Token expires in {timedelta(seconds=expires_seconds - now_seconds)}")
@@ -335,14 +815,15 @@ class Zermelo:
         if check and not self.check_token(token, instance_id):
             raise ZermeloAuthException(f"Invalid token: {token} for instance {instance_id}")
 
-        self.token = token
-        self.logger.debug(f"Set token: {self.token}")
+        with self._lock:
+            self.token = token
+            self.logger.debug(f"Set token: {self.token}")
 
-        self.instance_id = instance_id
-        self.logger.debug(f"Set instance id: {self.instance_id}")
+            self.instance_id = instance_id
+            self.logger.debug(f"Set instance id: {self.instance_id}")
 
-        self.logged_in = True
-        self.logger.debug(f"Set logged in: True")
+            self.logged_in = True
+            self.logger.debug(f"Set logged in: True")
 
         self.logger.info("Logged in")
 
@@ -367,13 +848,14 @@ class Zermelo:
             'response_type': 'code',
             'tenant': instance_id
         }
-        url = f'https://{instance_id}.zportal.nl/api/v{self.api_version}/oauth'
+        url = self.get_url(instance_id, 'oauth')
 
         try:
-            r = requests.post(url, data=data, allow_redirects=False)
+            r = self.get_session(instance_id).post(url, data=data, allow_redirects=False, timeout=self.timeout)
+            tracer.record_request('oauth', r.status_code, len(r.content), r.elapsed.total_seconds())
             r.raise_for_status()
 
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             raise ZermeloApiNetworkError("Could not reach the zermelo servers")
 
         except requests.exceptions.HTTPError as e:
@@ -422,13 +904,14 @@ class Zermelo:
             'grant_type': 'authorization_code',
             'rememberMe': True
         }
-        url = f'https://{instance_id}.zportal.nl/api/v{self.api_version}/oauth/token'
+        url = self.get_url(instance_id, 'oauth/token')
 
         try:
-            r = requests.post(url, data=data)
+            r = self.get_session(instance_id).post(url, data=data, timeout=self.timeout)
+            tracer.record_request('oauth/token', r.status_code, len(r.content), r.elapsed.total_seconds())
             r.raise_for_status()
 
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             raise ZermeloApiNetworkError("Could not reach the zermelo servers")
 
         except requests.exceptions.HTTPError:
@@ -462,13 +945,13 @@ class Zermelo:
             self.send_request('POST', 'oauth/logout')
 
             # Set logged in to False
-            self.token = None
-            self.instance_id = None
-            self.logged_in = False
+            with self._lock:
+                self.token = None
+                self.instance_id = None
+                self.logged_in = False
 
-            self._settings = {}
-            self._user = None
-            self.max_appointment_weeks = 52
+                self._settings = {}
+                self._user = None
 
             self.logger.info("Logged out")
         except ZermeloAuthException as e:
@@ -476,6 +959,9 @@ class Zermelo:
                 self.logger.warn("Not logged in while logging out")
             else:
                 raise e
+        finally:
+            # Drop the pooled connections, a new login opens a new session
+            self.close_session()
 
     def get_token(self):
         # Returns the token for later usage
@@ -0,0 +1,149 @@
+# Benchmarks the processing and gap engines on synthetic schedules.
+#
+#   PYTHONPATH=src python -m tests.benchmark --users 2,10,100 --weeks 1,4 --output bench.json
+#   PYTHONPATH=src python -m tests.benchmark --compare bench.json
+#
+# Every case is timed without tracemalloc (best of --repeat runs) and measured once more with tracemalloc
+# for the peak memory. The json output holds the commit, so results of different commits can be compared.
+import argparse
+import json
+import logging
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+
+from stickyhours.commonFreeHours import DayBuckets, get_common_free_intervals, get_common_gaps, \
+    get_common_gaps_bitset, process_user_data, process_user_intervals
+from tests.synthetic import SyntheticSchool
+
+ENGINES = {
+    'slots': (process_user_data, get_common_gaps),
+    'bitset': (process_user_data, get_common_gaps_bitset),
+    'minutes': (process_user_intervals, get_common_free_intervals),
+}
+
+
+def run(engine, payloads):
+    process, compute = ENGINES[engine]
+
+    start = time.perf_counter()
+
+    buckets = DayBuckets()
+    processed = [process(appointments, user, buckets) for user, appointments in payloads]
+    processed = [user_data for user_data in processed if user_data]
+
+    middle = time.perf_counter()
+
+    if processed:
+        compute(processed)
+
+    return middle - start, time.perf_counter() - middle
+
+
+def benchmark(school, users, weeks, engine, repeat):
+    payloads = [(user, school.appointments(user, weeks)) for user in users]
+    appointments = sum(len(user_appointments) for _, user_appointments in payloads)
+
+    process_seconds, gaps_seconds = min(run(engine, payloads) for _ in range(repeat))
+
+    tracemalloc.start()
+    run(engine, payloads)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'engine': engine,
+        'users': len(users),
+        'weeks': weeks,
+        'appointments': appointments,
+        'process_seconds': process_seconds,
+        'gaps_seconds': gaps_seconds,
+        'appointments_per_second': appointments / max(process_seconds + gaps_seconds, 1e-9),
+        'peak_bytes': peak,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, previous):
+    previous = {(r['engine'], r['users'], r['weeks']): r for r in previous['results']}
+
+    print(f"{'engine':>8} {'users':>6} {'weeks':>6} {'time':>8} {'memory':>8}")
+
+    for result in results['results']:
+        old = previous.get((result['engine'], result['users'], result['weeks']))
+        if old is None:
+            continue
+
+        seconds = result['process_seconds'] + result['gaps_seconds']
+        old_seconds = old['process_seconds'] + old['gaps_seconds']
+
+        print(f"{result['engine']:>8} {result['users']:>6} {result['weeks']:>6} "
+              f"{seconds / old_seconds:>7.2f}x {result['peak_bytes'] / max(old['peak_bytes'], 1):>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the gap pipeline on synthetic schedules.')
+    parser.add_argument('--users', default='2,10,100,1000', help='comma separated amounts of users')
+    parser.add_argument('--weeks', default='1,4,52', help='comma separated amounts of weeks')
+    parser.add_argument('--engines', default=','.join(ENGINES), help='comma separated engines')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-appointments', type=int, default=500_000,
+                        help='skip cases with more appointments (estimated) than this')
+    parser.add_argument('--output', type=Path, help='write the results as json')
+    parser.add_argument('--compare', type=Path, help='compare with the json results of an earlier run')
+    args = parser.parse_args()
+
+    # Skipped appointments are logged as warnings, which would be timed as well
+    logging.disable(logging.WARNING)
+
+    school = SyntheticSchool(args.seed, classes=40)
+    everyone = school.users()
+    random.Random(args.seed).shuffle(everyone)
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'results': []
+    }
+
+    print(f"{'engine':>8} {'users':>6} {'weeks':>6} {'appointments':>13} {'process':>9} {'gaps':>9} "
+          f"{'appts/s':>10} {'peak MiB':>9}")
+
+    for users in map(int, args.users.split(',')):
+        for weeks in map(int, args.weeks.split(',')):
+            # About 35 appointments per user per week
+            if users * weeks * 35 > args.max_appointments:
+                print(f"Skipping {users} users for {weeks} weeks, too many appointments")
+                continue
+
+            for engine in args.engines.split(','):
+                result = benchmark(school, everyone[:users], weeks, engine, args.repeat)
+                results['results'].append(result)
+
+                print(f"{engine:>8} {result['users']:>6} {weeks:>6} {result['appointments']:>13} "
+                      f"{result['process_seconds']:>8.4f}s {result['gaps_seconds']:>8.4f}s "
+                      f"{result['appointments_per_second']:>10.0f} {result['peak_bytes'] / 2 ** 20:>9.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
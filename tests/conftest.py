@@ -0,0 +1,39 @@
+import inspect
+
+import pytest
+
+from stickyhours.zapi import Zermelo
+from tests.synthetic import SyntheticSchool
+from tests.zermelo_server import INSTANCE, ZermeloStandIn
+
+
+@pytest.fixture
+def school():
+    # The school the stand-in serves, a test module overrides this fixture to serve another one
+    return SyntheticSchool(3, classes=4, students_per_class=5, teachers=8)
+
+
+@pytest.fixture
+def server(school):
+    with ZermeloStandIn(school) as server:
+        yield server
+
+
+@pytest.fixture
+def login(server):
+    # Logs a new client in to the stand-in as the user, the first student by default.
+    # An async client is returned from an awaitable.
+    def login(user=None, client=Zermelo, **kwargs):
+        zermelo = client(base_url=server.base_url, **kwargs)
+        result = zermelo.code_login(server.create_code(user or next(iter(server.school.students))), INSTANCE)
+
+        if inspect.isawaitable(result):
+            async def logged_in():
+                await result
+                return zermelo
+
+            return logged_in()
+
+        return zermelo
+
+    return login
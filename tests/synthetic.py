@@ -0,0 +1,174 @@
+# Seeded generator of synthetic zermelo appointment payloads, for tests and benchmarks.
+# Classes follow a weekly timetable of timeslots with free hours, teachers have hours without groups,
+# and some appointments are cancelled or have no timeslots. The same seed always gives the same school.
+import itertools
+import random
+from datetime import date, datetime, time, timedelta
+
+import pytz
+
+TIMEZONE = pytz.timezone('Europe/Amsterdam')
+
+# Monday 2024-09-02, first week of the school year
+FIRST_MONDAY = date(2024, 9, 2)
+
+# (hour, minute) of the start of every timeslot, lessons take 50 minutes
+TIMESLOTS = [(8, 30), (9, 20), (10, 25), (11, 15), (12, 35), (13, 25), (14, 30), (15, 20), (16, 10)]
+LESSON_MINUTES = 50
+
+SUBJECTS = ['ne', 'en', 'wi', 'na', 'sk', 'bi', 'gs', 'ak', 'fa', 'du', 'lo', 'ckv', 'in', 'econ']
+
+
+class SyntheticSchool:
+
+    def __init__(self, seed: int = 0, classes: int = 30, students_per_class: int = 28, teachers: int = 80,
+                 cancelled_ratio: float = 0.03, no_slot_ratio: float = 0.01, first_monday: date = FIRST_MONDAY):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.first_monday = first_monday
+        self.cancelled_ratio = cancelled_ratio
+        self.no_slot_ratio = no_slot_ratio
+
+        self.classes = [f'{self.rng.choice("hvg")}{self.rng.randint(1, 6)}{chr(97 + i % 26)}{i // 26 or ""}'
+                        for i in range(classes)]
+        self.teachers = [self._teacher_code(i) for i in range(teachers)]
+
+        self.students = {}
+        for class_index, group in enumerate(self.classes):
+            for i in range(students_per_class):
+                self.students[str(100000 + class_index * students_per_class + i)] = group
+
+        # Weekly timetable per class: weekday -> list of (first slot, last slot, subject, teacher)
+        self.timetables = {group: self._timetable() for group in self.classes}
+
+        # Teacher-only hours, like meetings, without groups
+        self.teacher_hours = {
+            teacher: [(self.rng.randrange(5), self.rng.randint(1, len(TIMESLOTS))) for _ in range(self.rng.randint(0, 3))]
+            for teacher in self.teachers
+        }
+
+    def _teacher_code(self, i):
+        return ''.join(chr(97 + (i * 7 + j * 3) % 26) for j in range(3)) + (str(i // 26) if i >= 26 else '')
+
+    def _timetable(self):
+        timetable = {}
+
+        for weekday in range(5):
+            first = self.rng.randint(1, 3)
+            last = self.rng.randint(5, len(TIMESLOTS))
+
+            lessons = []
+            slot = first
+            while slot <= last:
+                length = 2 if self.rng.random() < 0.1 and slot < last else 1
+
+                # Free hours in the middle of the day
+                if self.rng.random() > 0.15 or slot in (first, last):
+                    lessons.append((slot, slot + length - 1, self.rng.choice(SUBJECTS), self.rng.choice(self.teachers)))
+
+                slot += length
+
+            timetable[weekday] = lessons
+
+        return timetable
+
+    def users(self):
+        return list(self.students) + self.teachers
+
+    def _epoch(self, day: date, slot: int, minutes: int = 0):
+        hour, minute = TIMESLOTS[slot - 1]
+        start = TIMEZONE.localize(datetime.combine(day, time(hour, minute)))
+        return int((start + timedelta(minutes=minutes)).timestamp())
+
+    def _appointment(self, day, first_slot, last_slot, subject, teachers, groups, rng, ids):
+        appointment_id = next(ids)
+
+        cancelled = rng.random() < self.cancelled_ratio
+        has_slots = rng.random() >= self.no_slot_ratio
+        start = self._epoch(day, first_slot)
+        end = self._epoch(day, last_slot, LESSON_MINUTES)
+        created = start - 60 * 86400
+
+        return {
+            'appointmentInstance': appointment_id * 10,
+            'branch': 'main',
+            'branchOfSchool': 1,
+            'cancelled': cancelled,
+            'changeDescription': 'Vervallen' if cancelled else '',
+            'created': created,
+            'end': end,
+            'endTimeSlot': last_slot if has_slots else None,
+            'endTimeSlotName': f'u{last_slot}' if has_slots else None,
+            'groups': groups,
+            'groupsInDepartments': [sum(map(ord, group)) for group in groups],
+            'hidden': False,
+            'id': appointment_id,
+            'lastModified': created + rng.randint(0, 50 * 86400),
+            'locations': [f'{rng.choice("ABC")}{rng.randint(1, 40)}'],
+            'locationsOfBranch': [rng.randint(1, 200)],
+            'modified': cancelled,
+            'moved': False,
+            'new': False,
+            'remark': '',
+            'start': start,
+            'startTimeSlot': first_slot if has_slots else None,
+            'startTimeSlotName': f'u{first_slot}' if has_slots else None,
+            'subjects': [subject],
+            'teachers': teachers,
+            'type': 'lesson' if groups else 'activity',
+            'valid': not cancelled,
+        }
+
+    def appointments(self, user: str, weeks: int = 1, first_week: int = 0, valid_only: bool = True):
+        # The appointments of a user like the appointments endpoint returns them
+        rng = random.Random(f'{self.seed}/{user}/{first_week}/{weeks}')
+        ids = itertools.count(rng.randint(1, 10 ** 8))
+
+        appointments = []
+
+        for week in range(first_week, first_week + weeks):
+            monday = self.first_monday + timedelta(weeks=week)
+
+            for weekday in range(5):
+                day = monday + timedelta(days=weekday)
+
+                if user in self.students:
+                    group = self.students[user]
+                    for first_slot, last_slot, subject, teacher in self.timetables[group][weekday]:
+                        appointments.append(
+                            self._appointment(day, first_slot, last_slot, subject, [teacher], [group], rng, ids))
+                    continue
+
+                for group in self.classes:
+                    for first_slot, last_slot, subject, teacher in self.timetables[group][weekday]:
+                        if teacher == user:
+                            appointments.append(
+                                self._appointment(day, first_slot, last_slot, subject, [teacher], [group], rng, ids))
+
+                for hour_weekday, slot in self.teacher_hours[user]:
+                    if hour_weekday == weekday:
+                        appointments.append(self._appointment(day, slot, slot, 'overleg', [user], [], rng, ids))
+
+        if valid_only:
+            appointments = [a for a in appointments if a['valid'] and not a['cancelled']]
+
+        return sorted(appointments, key=lambda a: a['start'])
+
+    def week_start(self, week: int = 0) -> int:
+        return int(TIMEZONE.localize(datetime.combine(self.first_monday + timedelta(weeks=week), time())).timestamp())
+
+
+def response(data: list) -> dict:
+    # Wraps data like the zermelo api does
+    return {
+        'response': {
+            'status': 200,
+            'message': '',
+            'details': '',
+            'eventId': 0,
+            'startRow': 0,
+            'endRow': len(data),
+            'totalRows': len(data),
+            'data': data
+        }
+    }
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from stickyhours.accountindex import AccountIndex, AccountSearch, normalize
+
+ACCOUNTS = [
+    {'name': 'van Dijk (dij)', 'id': 'dij', 'teacher': True},
+    {'name': 'Bakker (bak)', 'id': 'bak', 'teacher': True},
+    {'name': 'Émile de Bakker (123456)', 'id': '123456', 'teacher': False},
+    {'name': 'Anna Dijkstra (123457)', 'id': '123457', 'teacher': False},
+    {'name': '234567', 'id': '234567', 'teacher': False},
+]
+
+
+def linear_search(accounts, query):
+    # The filter before the index
+    return {account['id'] for account in accounts if normalize(query) in normalize(f"{account['name']} {account['id']}")}
+
+
+def test_normalize():
+    assert normalize('  Émile  de BAKKER ') == 'emile de bakker'
+
+
+@pytest.mark.parametrize('query', ['', 'd', 'DI', 'dij', 'dijk', 'emile', 'bak', '1234', '(12345', 'x', 'kker (', 'z' * 5])
+def test_matches_linear_search(query):
+    assert {account['id'] for account in AccountIndex(ACCOUNTS).search(query)} == linear_search(ACCOUNTS, query)
+
+
+def test_ranking():
+    index = AccountIndex(ACCOUNTS)
+
+    # Exact code, then code prefix, then word prefix, then the rest
+    assert [account['id'] for account in index.search('bak')] == ['bak', '123456']
+    assert [account['id'] for account in index.search('dij')] == ['dij', '123457']
+    assert [account['id'] for account in index.search('23456')] == ['234567', '123456']
+    assert [account['id'] for account in index.search('123456', limit=1)] == ['123456']
+
+
+def test_incremental_search():
+    rng = random.Random(4)
+    accounts = [{'name': ''.join(rng.choice('abcde ') for _ in range(12)), 'id': str(i), 'teacher': False}
+                for i in range(300)]
+
+    index = AccountIndex(accounts)
+    search = AccountSearch(index)
+
+    # Typing, deleting and retyping gives the same result as a search from scratch
+    for query in ['a', 'ab', 'abc', 'ab', 'abd', 'b', 'b e', '', 'c', 'cd']:
+        assert [a['id'] for a in search.search(query)] == [a['id'] for a in index.search(query)]
+        assert {a['id'] for a in search.search(query)} == linear_search(accounts, query)
+
+
+def test_shared_index():
+    accounts = tuple(ACCOUNTS)
+    index = AccountIndex(accounts)
+
+    # The accounts are not copied, entries search the same index with their own state
+    assert index.accounts is accounts
+
+    first, second = AccountSearch(index), AccountSearch(index)
+    assert [a['id'] for a in first.search('dij')] == ['dij', '123457']
+    assert [a['id'] for a in second.search('1234', limit=1)] == ['123456']
+    assert [a['id'] for a in first.search('dijks')] == ['123457']
+    assert len(second.search('', limit=2)) == 2
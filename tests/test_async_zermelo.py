@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import pytest
+
+from stickyhours.zapi import AppointmentCache, AsyncZermelo, ZermeloAuthException, get_school_year
+from tests.zermelo_server import INSTANCE
+
+
+def test_login_and_accounts(server, login):
+    async def run():
+        async with await login(client=AsyncZermelo) as zermelo:
+            assert await zermelo.check_token(zermelo.get_token(), INSTANCE)
+
+            students, teachers = await asyncio.gather(zermelo.get_students(fields='code'),
+                                                      zermelo.get_teachers(fields='code'))
+
+            assert [student['code'] for student in students] == list(server.school.students)
+            assert len(teachers) == len(server.school.teachers)
+
+            with pytest.raises(ZermeloAuthException):
+                await AsyncZermelo(base_url=server.base_url).code_login('000000000000', INSTANCE)
+
+    asyncio.run(run())
+
+
+def test_concurrent_fetches(server, login):
+    server.latency = 0.02
+    users = list(server.school.students)
+
+    async def run():
+        async with await login(client=AsyncZermelo, max_concurrency=4) as zermelo:
+            server.reset_counts()
+
+            start = server.school.week_start(0)
+            results = await asyncio.gather(*[
+                zermelo.get_appointments(start, start + 7 * 86400 - 1, 'id,start,end', user) for user in users
+            ])
+
+            # The user and settings lookups of all fetches are coalesced into one
+            assert server.request_count('users/~me') == 1
+            assert server.request_count('schoolfunctionsettings') == 1
+
+            assert server.request_count('appointments') == len(users)
+            assert server.max_active <= 4
+
+            for user, appointments in zip(users, results):
+                assert [a['id'] for a in appointments] == [a['id'] for a in server.school.appointments(user)]
+
+    asyncio.run(run())
+
+
+def test_horizon(server, login):
+    server.horizon_weeks = 3
+
+    async def run():
+        async with await login(client=AsyncZermelo) as zermelo:
+            await zermelo.get_current_weeks_appointments(next(iter(server.school.students)), weeks=10)
+            assert zermelo.horizons.get(INSTANCE, get_school_year()) == 3
+
+    asyncio.run(run())
+
+
+def test_cached_appointments(server, login, tmp_path):
+    user = next(iter(server.school.students))
+
+    async def run():
+        cache = AppointmentCache(tmp_path / 'appointments')
+
+        async with await login(client=AsyncZermelo, cache=cache) as zermelo:
+            server.reset_counts()
+
+            first = await zermelo.get_current_weeks_appointments(user, weeks=2)
+            assert await zermelo.get_current_weeks_appointments(user, weeks=2) == first
+            assert server.request_count('appointments') == 1
+
+    asyncio.run(run())
+
+
+def test_cancellation(server, login):
+    async def run():
+        zermelo = await login(client=AsyncZermelo)
+        server.latency = 2
+
+        task = asyncio.create_task(zermelo.get_user())
+        await asyncio.sleep(0.1)
+
+        started = time.perf_counter()
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert time.perf_counter() - started < 1
+        await zermelo.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import pytest
+
+from stickyhours.zapi import AppointmentCache, DirectoryStore
+
+ACCOUNTS = [
+    {'name': 'van Dijk (dij)', 'id': 'dij', 'teacher': True},
+    {'name': 'Anna Dijkstra (123457)', 'id': '123457', 'teacher': False},
+]
+
+
+def test_directory_store(tmp_path):
+    store = DirectoryStore(tmp_path)
+
+    assert store.get('school', 2024) is None
+    assert store.put('school', 2024, tuple(ACCOUNTS))
+
+    # Read back from disk by a new store, like on the next launch
+    assert DirectoryStore(tmp_path).get('school', 2024) == ACCOUNTS
+    assert DirectoryStore(tmp_path).get('school', 2025) is None
+
+
+def test_unchanged_directory_is_not_written(tmp_path):
+    store = DirectoryStore(tmp_path)
+    store.put('school', 2024, ACCOUNTS)
+
+    file = tmp_path / 'school-2024.json'
+    file.unlink()
+
+    # Compared with the directory in memory, the file is not written again
+    assert not store.put('school', 2024, list(ACCOUNTS))
+    assert not file.exists()
+
+    assert store.put('school', 2024, ACCOUNTS[:1])
+    assert DirectoryStore(tmp_path).get('school', 2024) == ACCOUNTS[:1]
+
+    store.clear()
+    assert not file.exists()
+
+
+def test_appointment_cache_evicts_least_recently_read(tmp_path):
+    appointments = [{'id': i, 'start': i, 'lastModified': i} for i in range(20)]
+
+    cache = AppointmentCache(tmp_path, max_bytes=10 ** 6)
+    for key in 'abc':
+        cache.put(key, appointments)
+
+    entry_size = cache.size() // 3
+    assert cache.size() == sum(file.stat().st_size for file in tmp_path.glob('*.json'))
+
+    # Room for three and a half entries, reading a makes b the least recently used
+    cache.max_bytes = entry_size * 7 // 2
+    assert cache.get('a') is not None
+
+    def stored():
+        # Checked on disk, a get would mark the entries as used
+        return sorted(file.stem for file in tmp_path.glob('*.json'))
+
+    cache.put('d', appointments)
+    assert stored() == ['a', 'c', 'd']
+
+    # c was written before a was read and d was written, so it goes next
+    cache.put('e', appointments)
+    assert stored() == ['a', 'd', 'e']
+
+    # A new cache reads the sizes from disk once
+    assert AppointmentCache(tmp_path).size() == cache.size() == sum(f.stat().st_size for f in tmp_path.glob('*.json'))
+
+
+def test_appointment_cache_put_does_not_scan(tmp_path, monkeypatch):
+    cache = AppointmentCache(tmp_path)
+    cache.put('a', [])
+
+    # The sizes are tracked in memory after the first scan
+    monkeypatch.setattr(type(tmp_path), 'glob', lambda *args: pytest.fail('cache directory scanned'))
+    for key in 'bcd':
+        cache.put(key, [{'id': 1}])
+
+    assert cache.size() == sum(len(file.read_bytes()) for file in tmp_path.iterdir() if file.suffix == '.json')
@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from stickyhours.cli import main, read_groups
+from tests.synthetic import SyntheticSchool
+
+
+@pytest.fixture
+def school():
+    # A school where groups sharing a user used to narrow each other's timeslots with the slots engine
+    return SyntheticSchool(5, classes=3, students_per_class=3, teachers=6)
+
+
+def test_read_groups():
+    lines = ['# pairs\n', '100000 100003\n', '\n', 'abc, 100001,abc  # teacher and student\n']
+    assert read_groups(lines) == [['100000', '100003'], ['abc', '100001']]
+
+
+def test_batch(server, tmp_path):
+    students = list(server.school.students)
+
+    groups = tmp_path / 'groups.txt'
+    groups.write_text(f'{students[0]} {students[3]}\n{students[0]} {students[6]}\n{students[3]} unknown\n')
+    output = tmp_path / 'gaps.jsonl'
+
+    code = main([str(groups), '-o', str(output), '--token', server.create_token(students[0]), '--instance', 'school',
+                 '--base-url', server.base_url, '--cache-dir', str(tmp_path / 'cache'), '--weeks', '2'])
+
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+
+    assert code == 1
+    assert [result['users'] for result in results] == read_groups(groups.read_text().splitlines())
+    assert 'gaps' in results[0] and 'gaps' in results[1]
+    assert results[2]['error'] == {'unknown': 'No valid appointments'}
+
+    # Every user is fetched once, students[0] is in two groups
+    assert server.request_count('appointments') == 4
+    assert all(gap['start_time'] < gap['end_time'] for gap in results[0]['gaps'])
+
+
+def test_usage_errors(tmp_path, capsys):
+    # A missing groups file or a weeks amount below 1 is a usage error, not a traceback
+    groups = tmp_path / 'groups.txt'
+    groups.write_text('100000 100003\n')
+
+    for argv in ([str(tmp_path / 'missing.txt')], [str(groups), '--weeks', '0'], [str(groups), '--weeks', 'two']):
+        with pytest.raises(SystemExit) as e:
+            main(argv + ['--token', 'token', '--instance', 'school'])
+
+        assert e.value.code == 2
+        assert 'error:' in capsys.readouterr().err
+
+
+def test_no_gui_imports():
+    code = "import sys, stickyhours.cli; print(any(m == 'toga' or m.startswith(('toga.', 'stickyhours.utils')) for m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)})
+
+    assert result.stdout.strip() == 'False'
+
+
+def test_overlapping_groups_slots_engine(server, tmp_path):
+    # A user shared by groups is processed once, the result of a group must not depend on the groups before it
+    students = list(server.school.students)
+    token = server.create_token(students[0])
+
+    def run(name, groups):
+        path = tmp_path / f'{name}.txt'
+        path.write_text(''.join(' '.join(group) + '\n' for group in groups))
+        output = tmp_path / f'{name}.jsonl'
+
+        main([str(path), '-o', str(output), '--token', token, '--instance', 'school', '--base-url', server.base_url,
+              '--no-cache', '--weeks', '2', '--engine', 'slots'])
+
+        return [json.loads(line) for line in output.read_text().splitlines()]
+
+    # Every pair with students[0], in both orders, so each group follows others narrowing the same user
+    groups = [[students[0], other] for other in students[1:]]
+    groups += groups[::-1]
+    together = run('together', groups)
+
+    for group, result in zip(groups, together):
+        assert result == run(f'alone-{group[1]}', [group])[0]
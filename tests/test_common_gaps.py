@@ -0,0 +1,177 @@
+import copy
+import random
+from datetime import date, datetime
+
+import pytest
+import pytz
+
+from stickyhours.commonFreeHours import DayBuckets, get_common_gaps, get_common_gaps_bitset, process_user_data, \
+    process_user_intervals, get_common_free_intervals, appointment_fields, compute_gaps, process_appointments, GAP_ENGINES
+from tests.synthetic import SyntheticSchool
+
+# Monday 2024-10-14 00:00 Europe/Amsterdam
+MONDAY = 1728856800
+MONDAY_DAY = date(2024, 10, 14).toordinal()
+
+
+def random_appointments(rng: random.Random, days: int = 5):
+    appointments = []
+
+    for day in range(days):
+        if rng.random() < 0.1:
+            continue
+
+        slot = rng.randint(1, 3)
+        while slot <= 9:
+            length = rng.choice([1, 1, 1, 2])
+            start = MONDAY + day * 86400 + 8 * 3600 + (slot - 1) * 3000 + rng.randint(-300, 300)
+
+            appointments.append({
+                'start': start,
+                'end': start + length * 3000 - 600,
+                'startTimeSlot': slot,
+                'endTimeSlot': slot + length - 1,
+                'groups': ['g'],
+                'teachers': ['t'],
+            })
+
+            slot += length + rng.choice([0, 0, 0, 1, 2])
+
+    return appointments
+
+
+@pytest.mark.parametrize('seed', range(50))
+@pytest.mark.parametrize('sticky_hours', [0, 1, 3])
+def test_bitset_engine_matches_reference(seed, sticky_hours):
+    rng = random.Random(seed)
+
+    data = [process_user_data(random_appointments(rng), f'u{i}') for i in range(rng.randint(1, 6))]
+
+    expected = get_common_gaps(copy.deepcopy(data), sticky_hours=sticky_hours)
+
+    assert get_common_gaps_bitset(copy.deepcopy(data), sticky_hours=sticky_hours) == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_bitset_engine_matches_reference_on_synthetic_school(seed):
+    school = SyntheticSchool(seed, classes=4, students_per_class=5, teachers=10)
+    users = random.Random(seed).sample(school.users(), 4)
+
+    data = [process_user_data(school.appointments(user, weeks=2), user) for user in users]
+
+    for sticky_hours in (0, 2):
+        expected = get_common_gaps(copy.deepcopy(data), sticky_hours=sticky_hours)
+        assert get_common_gaps_bitset(copy.deepcopy(data), sticky_hours=sticky_hours) == expected
+
+
+@pytest.mark.parametrize('engine', GAP_ENGINES)
+def test_projected_fields_give_the_same_gaps(engine):
+    school = SyntheticSchool(2, classes=4, students_per_class=5, teachers=10)
+    users = random.Random(2).sample(school.users(), 4)
+
+    def gaps(project):
+        data = []
+
+        for user in users:
+            appointments = school.appointments(user, weeks=2)
+
+            if project:
+                fields = appointment_fields(engine, user in school.teachers).split(',')
+                appointments = [{field: a[field] for field in fields} for a in appointments]
+
+            data.append(process_appointments(appointments, user, engine))
+
+        return compute_gaps(data, engine, sticky_hours=1)
+
+    assert gaps(True) == gaps(False)
+
+    # Students never teach, their appointments are fetched without the teachers
+    assert 'teachers' not in appointment_fields(engine, is_teacher=False)
+    assert 'startTimeSlot' not in appointment_fields('minutes')
+
+
+def test_gap_after_rejected_gap():
+    # The gap at slot 2 is before the latest first hour, the gap at slot 5 is still common
+    def appointment(start_slot, end_slot):
+        start = MONDAY + 8 * 3600 + (start_slot - 1) * 3000
+        return {'start': start, 'end': start + (end_slot - start_slot + 1) * 3000 - 600, 'startTimeSlot': start_slot,
+                'endTimeSlot': end_slot, 'groups': ['g'], 'teachers': []}
+
+    data = [
+        process_user_data([appointment(1, 1), appointment(4, 4), appointment(6, 6)], 'a'),
+        process_user_data([appointment(3, 4), appointment(6, 6)], 'b'),
+    ]
+
+    for engine in (get_common_gaps, get_common_gaps_bitset):
+        gaps = engine(copy.deepcopy(data))
+        assert [(gap['start_slot'], gap['end_slot']) for gap in gaps[MONDAY_DAY]] == [(5, 5)]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_minutes_engine_matches_slot_gap_times(seed):
+    # The breaks between lessons are shorter than the minimum length, so only free hours remain
+    rng = random.Random(seed)
+
+    users = [random_appointments(rng) for _ in range(rng.randint(1, 6))]
+
+    slot_gaps = get_common_gaps_bitset([process_user_data(appointments, 'u') for appointments in users])
+    free_intervals = get_common_free_intervals([process_user_intervals(appointments, 'u') for appointments in users],
+                                               min_length=30 * 60)
+
+    assert free_intervals == {
+        date: [{'start_time': gap['start_time'], 'end_time': gap['end_time']} for gap in gaps]
+        for date, gaps in slot_gaps.items()
+    }
+
+
+@pytest.mark.parametrize('engine', GAP_ENGINES)
+def test_no_users_or_no_valid_appointments(engine):
+    assert compute_gaps([], engine) == {}
+
+    # A user without valid appointments has no days in common with anyone
+    data = [process_appointments([], 'u0', engine), process_appointments(random_appointments(random.Random(1)), 'u1', engine)]
+    assert compute_gaps(data, engine) == {}
+
+
+def test_minutes_engine_uses_appointments_without_timeslots():
+    start = MONDAY + 8 * 3600
+
+    users = [
+        [{'start': start, 'end': start + 3600, 'groups': ['g']},
+         {'start': start + 7200, 'end': start + 10800, 'groups': ['g']}],
+        [{'start': start, 'end': start + 10800, 'startTimeSlot': 1, 'endTimeSlot': 3, 'groups': ['g']}],
+        [{'start': start + 1800, 'end': start + 9000, 'groups': [], 'teachers': ['t']}],
+    ]
+
+    gaps = get_common_free_intervals([process_user_intervals(appointments, 'u') for appointments in users[:1]])
+    assert gaps == {MONDAY_DAY: [{'start_time': start + 3600, 'end_time': start + 7200}]}
+
+    # The appointment of the third user is not theirs, so that day has no appointments for them
+    gaps = get_common_free_intervals([process_user_intervals(appointments, 'u') for appointments in users])
+    assert gaps == {}
+
+
+def test_minutes_engine_sticky_hours_use_the_lesson_length():
+    # The gaps are an hour outside the hours both users have appointments
+    start = MONDAY + 8 * 3600
+    users = [
+        [{'start': start, 'end': start + 3600, 'groups': ['g']},
+         {'start': start + 4 * 3600, 'end': start + 5 * 3600, 'groups': ['g']}],
+        [{'start': start + 2 * 3600, 'end': start + 3 * 3600, 'groups': ['g']}],
+    ]
+    data = [process_user_intervals(appointments, 'u') for appointments in users]
+
+    assert compute_gaps(data, 'minutes', sticky_hours=1) == {}
+    assert len(compute_gaps(data, 'minutes', sticky_hours=1, lesson_length=3600)[MONDAY_DAY]) == 2
+
+
+@pytest.mark.parametrize('timezone', ['Europe/Amsterdam', 'America/New_York', 'UTC'])
+def test_day_buckets_match_local_dates(timezone):
+    buckets = DayBuckets(timezone)
+    tz = pytz.timezone(timezone)
+
+    # Every 17 minutes over two months, including a daylight saving time change, in both directions
+    epochs = list(range(MONDAY, MONDAY + 60 * 86400, 17 * 60))
+
+    for epoch in epochs + epochs[::-1]:
+        assert buckets.day(epoch) == datetime.fromtimestamp(epoch, tz=tz).date().toordinal()
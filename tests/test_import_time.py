@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# A cold import of the core may take this factor of importing the modules it depends on, measured in the same run
+# so the budget scales with the machine, plus a fixed margin for the own code of the package
+IMPORT_FACTOR = 1.5
+IMPORT_MARGIN = 0.05
+
+# Gui and development only dependencies, the core never needs them
+HEAVY_MODULES = ['toga', 'babel', 'freezegun', 'platformdirs', 'pprint', 'stickyhours.utils', 'stickyhours.app']
+
+
+def cold_import(module, statement=None):
+    # Imports the module in a new interpreter, returns the import time and the imported modules, leaving out the
+    # modules created by extensions that cannot be imported by name
+    statement = statement or f"import {module}"
+    code = (f"import json, sys, time; start = time.perf_counter(); {statement}; "
+            f"print(json.dumps([time.perf_counter() - start, "
+            f"[name for name, m in sys.modules.items() if getattr(m, '__spec__', None) is not None]]))")
+
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)})
+
+    seconds, modules = json.loads(result.stdout)
+    return seconds, set(modules)
+
+
+@pytest.mark.parametrize('module', ['stickyhours.zapi', 'stickyhours.commonFreeHours', 'stickyhours.cli'])
+def test_core_import(module):
+    seconds, modules = cold_import(module)
+
+    assert not modules & set(HEAVY_MODULES)
+
+    # The same dependencies imported without the package
+    _, startup = cold_import(None, 'pass')
+    dependencies = sorted({name.split('.')[0] for name in modules - startup} - {'stickyhours'})
+    baseline, _ = cold_import(None, f"import {', '.join(dependencies)}")
+
+    assert seconds < baseline * IMPORT_FACTOR + IMPORT_MARGIN
+
+
+def test_processing_does_not_import_the_client():
+    _, modules = cold_import('stickyhours.commonFreeHours')
+
+    assert 'requests' not in modules
+    assert 'stickyhours.zapi.zermelo' not in modules
+
+
+def test_star_import_skips_the_optional_clients():
+    # The app star imports zapi, the async client and the pool are only imported when asked for by name
+    _, modules = cold_import('stickyhours.zapi', 'from stickyhours.zapi import *')
+
+    assert 'stickyhours.zapi.zermelo' in modules
+    assert not modules & {'httpx', 'stickyhours.zapi.async_zermelo', 'stickyhours.zapi.pool'}
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from stickyhours.zapi import ZermeloPool
+from stickyhours.zapi.exceptions import ZermeloAuthException, ZermeloPoolFullError, ZermeloValueError
+from stickyhours.zapi.resilience import RateLimiter
+
+INSTANCES = ['school-a', 'school-b', 'school-c']
+
+
+def make_pool(server, **kwargs):
+    pool = ZermeloPool(base_url=server.base_url, **kwargs)
+
+    for instance_id, user in zip(INSTANCES, server.school.students):
+        pool.add(instance_id, server.create_token(user))
+
+    return pool
+
+
+def test_clients_per_instance(server):
+    with make_pool(server) as pool:
+        users = {}
+
+        for instance_id in INSTANCES:
+            with pool.client(instance_id) as zermelo:
+                assert zermelo.get_instance_id() == instance_id
+                users[instance_id] = zermelo.get_user()['code']
+
+        assert list(users.values()) == list(server.school.students)[:3]
+
+        # Logging one instance out leaves the others logged in
+        pool.remove('school-a', logout=True)
+        assert pool.instances() == INSTANCES[1:]
+
+        with pool.client('school-b') as zermelo:
+            assert zermelo.get_user()
+
+        with pytest.raises(ZermeloAuthException):
+            pool.add('school-d', 'invalid')
+        assert 'school-d' not in pool
+
+
+def test_bounded_clients_and_connections(server):
+    with make_pool(server, max_clients=2, max_connections=4) as pool:
+        assert pool.pool_size == 2
+
+        for instance_id in INSTANCES:
+            with pool.client(instance_id) as zermelo:
+                assert zermelo.pool_size == 2
+                zermelo.get_user()
+
+        # The least recently used client was closed, its token is kept to open it again
+        assert pool.open_clients() == INSTANCES[1:]
+        assert len(pool) == 3
+
+        with pool.client('school-a') as zermelo:
+            assert zermelo.get_user()
+
+        # All open clients in use, no room for another
+        with pool.client('school-a'), pool.client('school-b'):
+            with pytest.raises(ZermeloPoolFullError):
+                with pool.client('school-c'):
+                    pass
+
+
+def test_connections_stay_within_the_limit(server):
+    server.latency = 0.05
+
+    with make_pool(server, max_clients=2, max_connections=2) as pool:
+        server.reset_counts()
+
+        def fetch(instance_id):
+            with pool.client(instance_id) as zermelo:
+                zermelo.send_request('GET', 'users/~me')
+
+        # Three requests at once per instance, each client has a single connection
+        threads = [threading.Thread(target=fetch, args=(instance_id,)) for instance_id in INSTANCES[:2] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert server.request_count('users/~me') == 6
+        assert server.max_active <= 2
+
+
+def test_idle_eviction(server):
+    with make_pool(server, idle_timeout=0.05) as pool:
+        with pool.client('school-a') as zermelo:
+            zermelo.get_user()
+
+            # In use, not evicted
+            time.sleep(0.06)
+            pool.evict_idle()
+            assert pool.open_clients() == ['school-a']
+
+        time.sleep(0.06)
+        assert pool.evict_idle() == 1
+        assert pool.open_clients() == []
+
+
+def test_client_in_use_is_closed_on_release(server):
+    with make_pool(server) as pool:
+        with pool.client('school-a') as zermelo:
+            zermelo.get_user()
+
+            # Replaced and removed while in use, its session stays open for the requests in flight
+            pool.add('school-a', server.create_token(next(iter(server.school.students))), check=False)
+            pool.remove('school-a')
+            assert zermelo._session is not None
+
+        assert zermelo._session is None
+
+
+def test_pool_sets_the_connections_of_its_clients(server):
+    with pytest.raises(ZermeloValueError):
+        ZermeloPool(base_url=server.base_url, pool_size=4)
+
+
+def test_expired_token_removes_instance(server):
+    with make_pool(server) as pool:
+        server.expire_tokens()
+
+        with pytest.raises(ZermeloAuthException):
+            with pool.client('school-b') as zermelo:
+                zermelo.get_user()
+
+        assert 'school-b' not in pool
+
+
+def test_rate_limit(server):
+    with make_pool(server, rate=20, burst=1) as pool:
+        def fetch(instance_id):
+            with pool.client(instance_id) as zermelo:
+                for _ in range(4):
+                    zermelo.send_request('GET', 'users/~me')
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=fetch, args=(instance_id,)) for instance_id in INSTANCES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 4 requests at 20 per second take 0.15 seconds, the instances are limited separately
+        assert 0.14 <= time.perf_counter() - started < 0.6
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(10, burst=2)
+
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
@@ -0,0 +1,177 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+from stickyhours.zapi import AsyncZermelo
+from stickyhours.zapi.exceptions import ZermeloApiHttpStatusException, ZermeloApiNetworkError, ZermeloCircuitOpenError
+from stickyhours.zapi.resilience import CircuitBreaker, RetryPolicy, parse_retry_after
+from tests.zermelo_server import INSTANCE
+
+# Retries without noticeable waiting
+FAST = dict(backoff=0.01, max_backoff=0.02)
+
+
+def test_parse_retry_after():
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after(format_datetime(now + timedelta(seconds=5), usegmt=True), now) == 5
+    assert parse_retry_after(format_datetime(now - timedelta(seconds=5), usegmt=True), now) == 0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+
+def test_backoff_is_bounded():
+    policy = RetryPolicy(max_attempts=10, backoff=1, max_backoff=4, max_elapsed=60, rng=random.Random(1))
+    started = time.monotonic()
+
+    for attempt in range(9):
+        assert 0 <= policy.next_delay(attempt, started) <= min(4, 2 ** attempt)
+
+    # Out of attempts, or waiting would take past the total budget
+    assert policy.next_delay(9, started) is None
+    assert policy.next_delay(0, started, retry_after=61) is None
+
+    assert policy.retryable('GET', 503) and policy.retryable('GET')
+    assert not policy.retryable('POST', 503) and not policy.retryable('GET', 404)
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(INSTANCE, failure_threshold=2, reset_timeout=0.05)
+
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+
+    with pytest.raises(ZermeloCircuitOpenError):
+        breaker.before_request()
+
+    # One trial request after the reset timeout, its failure opens the circuit again
+    time.sleep(0.06)
+    breaker.before_request()
+    with pytest.raises(ZermeloCircuitOpenError):
+        breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    time.sleep(0.06)
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_retries_transient_errors(server, login):
+    zermelo = login(retry=RetryPolicy(**FAST))
+    server.reset_counts()
+    server.fail_next = 2
+    server.error_status = 503
+
+    assert zermelo.send_request('GET', 'users/~me').get('data')
+    assert server.request_count('users/~me') == 3
+
+
+def test_gives_up_after_max_attempts(server, login):
+    zermelo = login(retry=RetryPolicy(max_attempts=2, **FAST))
+    server.reset_counts()
+    server.fail_next = 5
+
+    with pytest.raises(ZermeloApiHttpStatusException):
+        zermelo.send_request('GET', 'users/~me')
+    assert server.request_count('users/~me') == 2
+
+    # Client errors and non idempotent requests are not retried
+    server.reset_counts()
+    server.fail_next = 1
+    server.error_status = 404
+    with pytest.raises(ZermeloApiHttpStatusException):
+        zermelo.send_request('GET', 'users/~me')
+    assert server.request_count('users/~me') == 1
+
+
+def test_retry_after_is_honoured(server, login):
+    zermelo = login(retry=RetryPolicy(max_elapsed=5, **FAST))
+    server.fail_next = 1
+    server.error_status = 429
+    server.retry_after = 1
+
+    started = time.perf_counter()
+    assert zermelo.send_request('GET', 'users/~me')
+    assert time.perf_counter() - started >= 1
+
+    # A wait past the total budget is not started
+    zermelo.retry.max_elapsed = 0.5
+    server.fail_next = 1
+    started = time.perf_counter()
+    with pytest.raises(ZermeloApiHttpStatusException):
+        zermelo.send_request('GET', 'users/~me')
+    assert time.perf_counter() - started < 0.5
+
+
+def test_retries_end_within_the_budget(server, login):
+    # The first attempt takes its full timeout, the retry only gets the time left of the budget
+    zermelo = login(retry=RetryPolicy(max_elapsed=0.5, **FAST), timeout=(1, 1))
+    server.latency = 0.3
+    server.fail_next = 1
+    server.error_status = 503
+
+    started = time.perf_counter()
+    with pytest.raises(ZermeloApiNetworkError):
+        zermelo.send_request('GET', 'users/~me')
+    assert time.perf_counter() - started < 0.6
+
+
+def test_open_circuit_sends_nothing(server, login):
+    zermelo = login(retry=RetryPolicy(max_attempts=1), breaker_threshold=3, breaker_reset=60)
+    server.error_rate = 1.0
+
+    for _ in range(3):
+        with pytest.raises(ZermeloApiHttpStatusException):
+            zermelo.send_request('GET', 'users/~me')
+
+    server.reset_counts()
+    with pytest.raises(ZermeloCircuitOpenError):
+        zermelo.send_request('GET', 'users/~me')
+    assert server.request_count('users/~me') == 0
+
+    # Other instances have their own breaker
+    assert zermelo.get_breaker('other').state == 'closed'
+
+
+def test_failed_trial_request_reopens_the_circuit(server, login, monkeypatch):
+    zermelo = login(retry=RetryPolicy(max_attempts=1), breaker_threshold=1, breaker_reset=0.05)
+    server.fail_next = 1
+
+    with pytest.raises(ZermeloApiHttpStatusException):
+        zermelo.send_request('GET', 'users/~me')
+
+    # The trial request fails with an error that is not a network error
+    time.sleep(0.06)
+    with monkeypatch.context() as m:
+        m.setattr(zermelo, '_send', lambda *args: (_ for _ in ()).throw(requests.exceptions.TooManyRedirects()))
+        with pytest.raises(requests.exceptions.TooManyRedirects):
+            zermelo.send_request('GET', 'users/~me')
+
+    assert zermelo.get_breaker(INSTANCE).state == 'open'
+
+    time.sleep(0.06)
+    assert zermelo.send_request('GET', 'users/~me')
+
+
+def test_async_retries(server, login):
+    async def run():
+        zermelo = await login(client=AsyncZermelo, retry=RetryPolicy(**FAST))
+
+        server.reset_counts()
+        server.fail_next = 2
+
+        assert await zermelo.get_user()
+        assert server.request_count('users/~me') == 3
+
+        await zermelo.aclose()
+
+    asyncio.run(run())
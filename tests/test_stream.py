@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from stickyhours.zapi.exceptions import ZermeloApiDataException
+from stickyhours.zapi.stream import iter_response_data
+
+DATA = [
+    {'id': 1, 'groups': ['v5a', 'v5b'], 'remark': 'Room "B1" [moved], {see portal}'},
+    {'id': 2, 'groups': [], 'teachers': ['abc'], 'remark': 'escaped \\" quote and unicode é'},
+    {'id': 3, 'nested': {'data': [1, 2, 3]}},
+]
+
+BODY = json.dumps({'response': {
+    'status': 200, 'message': 'data', 'details': '', 'eventId': 0, 'startRow': 0, 'endRow': 3, 'totalRows': 3,
+    'data': DATA
+}}, indent=1)
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, len(BODY)])
+def test_items_are_parsed_across_chunks(size):
+    assert list(iter_response_data(chunked(BODY, size))) == DATA
+
+
+def test_response_without_data():
+    assert list(iter_response_data([json.dumps({'response': {'status': 200, 'message': ''}})])) == []
+
+
+def test_truncated_response():
+    with pytest.raises(ZermeloApiDataException):
+        list(iter_response_data(chunked(BODY[:len(BODY) // 2], 16)))
@@ -0,0 +1,31 @@
+import json
+
+from stickyhours.tracing import Tracer
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+
+    with tracer.span('fetch', user='abc'):
+        pass
+    tracer.record_request('appointments', 200, 100, 0.1)
+
+    assert tracer.requests() == {}
+
+
+def test_export(tmp_path):
+    tracer = Tracer(enabled=True)
+
+    with tracer.span('fetch', user='abc'):
+        tracer.record_request('appointments', 200, 100, 0.1)
+        tracer.record_request('appointments', 403, 20, 0.3)
+
+    tracer.export(tmp_path / 'trace.json')
+
+    with open(tmp_path / 'trace.json') as f:
+        trace = json.load(f)
+
+    assert [(event['name'], event['args']) for event in trace['traceEvents']] == [('fetch', {'user': 'abc'})]
+    assert trace['requests'] == {
+        'appointments': {'count': 2, 'errors': 1, 'bytes': 120, 'seconds': 0.4, 'max_seconds': 0.3}
+    }
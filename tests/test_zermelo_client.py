@@ -0,0 +1,280 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from stickyhours.zapi import AppointmentCache, Zermelo, get_school_year
+from stickyhours.zapi.exceptions import ZermeloAuthException, ZermeloApiDataException, ZermeloApiHttpStatusException
+from stickyhours.zapi.zermelo import SingleFlight, merge_appointments, split_weeks
+from tests.synthetic import TIMEZONE
+from tests.zermelo_server import INSTANCE
+
+
+def test_code_login_and_accounts(server, login):
+    zermelo = login()
+
+    assert zermelo.check_token(zermelo.get_token(), INSTANCE)
+    assert zermelo.get_user()['isStudent']
+
+    students = zermelo.get_students(fields='code,firstName,lastName')
+    assert [student['code'] for student in students] == list(server.school.students)
+    assert set(students[0]) == {'code', 'firstName', 'lastName'}
+
+    assert len(zermelo.get_teachers(fields='code')) == len(server.school.teachers)
+
+
+def test_closed_stream_releases_the_connection(login):
+    # A single blocking connection, a stream holding it would make the next request wait forever
+    zermelo = login(pool_size=1, pool_block=True)
+    zermelo.get_settings()
+
+    zermelo.get_students(fields='code', stream=True).close()
+
+    with zermelo.get_students(fields='code', stream=True) as students:
+        next(students)
+
+    thread = threading.Thread(target=zermelo.get_teachers, kwargs={'fields': 'code'}, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+
+
+def test_invalid_code(server):
+    with pytest.raises(ZermeloAuthException):
+        Zermelo(base_url=server.base_url).code_login('000000000000', INSTANCE)
+
+
+def test_expired_session(server, login):
+    zermelo = login()
+    server.expire_tokens()
+
+    with pytest.raises(ZermeloAuthException):
+        zermelo.get_user()
+
+    assert not zermelo.logged_in
+
+
+def test_appointments(server, login):
+    zermelo = login()
+    user = next(iter(server.school.students))
+
+    start, end = server.school.week_start(0), server.school.week_start(1) - 1
+    appointments = zermelo.get_appointments(start, end, 'id,start,end,groups', user)
+
+    expected = server.school.appointments(user, 1, 0)
+    assert [a['id'] for a in appointments] == [a['id'] for a in expected]
+
+
+def test_horizon_is_probed_and_remembered(server, login):
+    server.horizon_weeks = 5
+    zermelo = login()
+    user = next(iter(server.school.students))
+
+    zermelo.get_current_weeks_appointments(user, weeks=40)
+    assert server.request_count('appointments') <= 8
+    assert zermelo.horizons.get(INSTANCE, get_school_year()) == 5
+
+    # The remembered horizon is used right away
+    server.reset_counts()
+    zermelo.get_current_weeks_appointments(user, weeks=40)
+    assert server.request_count('appointments') == 1
+
+
+def test_stale_cache_is_synced(server, tmp_path, login):
+    cache = AppointmentCache(tmp_path, max_age=0)
+    zermelo = login(cache=cache)
+    user = next(iter(server.school.students))
+
+    start, end = server.school.week_start(0), server.school.week_start(1) - 1
+
+    first = zermelo.get_appointments(start, end, 'start,end,groups', user)
+    second = zermelo.get_appointments(start, end, 'start,end,groups', user)
+
+    assert first == second
+    assert server.request_count('appointments') == 2
+
+
+def test_merge_appointments():
+    cached = [{'id': 1, 'start': 10, 'lastModified': 5}, {'id': 2, 'start': 20, 'lastModified': 6},
+              {'id': 3, 'start': 30, 'lastModified': 7}]
+    changes = [
+        {'id': 2, 'start': 25, 'lastModified': 9, 'valid': True, 'cancelled': False},
+        {'id': 3, 'start': 30, 'lastModified': 8, 'valid': True, 'cancelled': True},
+        {'id': 4, 'start': 5, 'lastModified': 11, 'valid': True, 'cancelled': False},
+        {'id': 1, 'start': 10, 'lastModified': 10, 'valid': False, 'cancelled': False},
+    ]
+
+    # Modified ones are replaced by id, cancelled and invalid ones removed, new ones added in order of start
+    merged, modified = merge_appointments(cached, changes, 7, valid_only=True)
+    assert [(a['id'], a['start']) for a in merged] == [(4, 5), (2, 25)]
+    assert modified == 11
+
+    # Without valid_only the cancelled and invalid ones are kept with their new state
+    merged, _ = merge_appointments(cached, changes, 7, valid_only=False)
+    assert [a['id'] for a in merged] == [4, 1, 2, 3]
+    assert merged[3]['cancelled']
+
+    # No changes keep the entry and the high-water mark
+    assert merge_appointments(cached, [], 7, valid_only=True) == (cached, 7)
+
+
+def test_modified_appointments_are_synced(server, tmp_path, login):
+    cache = AppointmentCache(tmp_path, max_age=0)
+    zermelo = login(cache=cache)
+    user = next(iter(server.school.students))
+
+    start, end = server.school.week_start(0), server.school.week_start(1) - 1
+    fields = 'id,start,end,groups'
+
+    first = zermelo.get_appointments(start, end, fields, user)
+    changed, cancelled = first[0], first[1]
+
+    server.modify_appointment(changed['id'], groups=['other'])
+    server.modify_appointment(cancelled['id'], cancelled=True)
+    server.reset_counts()
+
+    second = zermelo.get_appointments(start, end, fields, user)
+
+    # Only the modified appointments were requested, and merged into the cached ones
+    assert server.request_count('appointments') == 1
+    assert [a['id'] for a in second] == [a['id'] for a in first if a['id'] != cancelled['id']]
+    assert second[0]['groups'] == ['other']
+
+    entry = cache.get(cache.key(INSTANCE, user, start, end, fields, True))
+    assert entry['modified'] == server.changes[cancelled['id']]['lastModified']
+
+
+def test_injected_errors(server, login):
+    zermelo = login()
+    server.error_rate = 1.0
+
+    with pytest.raises(ZermeloApiHttpStatusException):
+        zermelo.send_request('GET', 'users/~me')
+
+
+def test_token_expires(server, login):
+    zermelo = login()
+
+    expires = zermelo.get_token_expires(zermelo.get_token(), INSTANCE)
+    assert expires - time.time() == pytest.approx(server.token_lifetime, abs=60)
+
+    server.expire_tokens()
+    with pytest.raises(ZermeloAuthException):
+        zermelo.get_token_expires(zermelo.get_token(), INSTANCE)
+
+
+def test_concurrent_lookups_are_coalesced(server, login):
+    zermelo = login()
+    server.latency = 0.05
+    server.reset_counts()
+
+    users = list(server.school.students)
+    start, end = server.school.week_start(0), server.school.week_start(1) - 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda user: zermelo.get_appointments(start, end, 'id', user), users))
+
+    # Every fetch needs the user and the settings, they are requested once
+    assert server.request_count('users/~me') == 1
+    assert server.request_count('schoolfunctionsettings') == 1
+    assert server.request_count('appointments') == len(users)
+
+    assert [len(appointments) for appointments in results] == [len(server.school.appointments(u)) for u in users]
+
+
+def test_single_flight_errors():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def failing():
+        calls.append(1)
+        release.wait()
+        raise ValueError('failed')
+
+    def call():
+        try:
+            flight.do('key', failing)
+        except ValueError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(call) for _ in range(4)]
+        time.sleep(0.1)
+        release.set()
+
+    # The waiting callers get the exception of the call they joined
+    assert len(calls) == 1
+    assert all(isinstance(future.result(), ValueError) for future in futures)
+
+
+def test_split_weeks():
+    # Wednesday 10:00 up to the tuesday two weeks later 12:00
+    start = datetime(2024, 9, 4, 10)
+    end = datetime(2024, 9, 17, 12)
+
+    assert split_weeks(start, end) == [
+        (start, datetime(2024, 9, 8, 23, 59, 59)),
+        (datetime(2024, 9, 9), datetime(2024, 9, 15, 23, 59, 59)),
+        (datetime(2024, 9, 16), end),
+    ]
+
+    # A range within one week is a single clipped chunk
+    assert split_weeks(start, start + timedelta(hours=1)) == [(start, start + timedelta(hours=1))]
+
+
+def week_range(server, weeks):
+    start = datetime.fromtimestamp(server.school.week_start(0), tz=TIMEZONE)
+    end = datetime.fromtimestamp(server.school.week_start(weeks) - 1, tz=TIMEZONE)
+    return start, end
+
+
+def test_iter_appointments_out_of_order(server, login):
+    zermelo = login()
+    user = next(iter(server.school.students))
+
+    # The first week arrives last
+    server.week_latency = {0: 0.3}
+    start, end = week_range(server, 3)
+
+    weeks = list(zermelo.iter_appointments(start, end, user, fields='id,start,end', max_workers=3))
+
+    assert [week_start for week_start, _ in weeks][-1] == start
+    assert sorted(week_start for week_start, _ in weeks) == [start + timedelta(weeks=week) for week in range(3)]
+
+    ids = sorted(a['id'] for _, appointments in weeks for a in appointments)
+    assert ids == sorted(a['id'] for week in range(3) for a in server.school.appointments(user, 1, week, valid_only=False))
+
+
+def test_iter_appointments_skips_forbidden_weeks(server, login):
+    zermelo = login()
+    user = next(iter(server.school.students))
+
+    server.forbidden_weeks = {1}
+    start, end = week_range(server, 3)
+
+    weeks = dict(zermelo.iter_appointments(start, end, user, fields='id'))
+    assert sorted(weeks) == [start, start + timedelta(weeks=2)]
+
+    with pytest.raises(ZermeloApiDataException):
+        list(zermelo.iter_appointments(start, end, user, fields='id', skip_forbidden=False))
+
+
+def test_iter_appointments_close_cancels_remaining_weeks(server, login):
+    zermelo = login()
+    user = next(iter(server.school.students))
+
+    server.latency = 0.05
+    start, end = week_range(server, 6)
+    server.reset_counts()
+
+    weeks = zermelo.iter_appointments(start, end, user, fields='id', max_workers=1)
+    assert next(weeks)[0] == start
+    weeks.close()
+
+    # The week in flight when closing is finished, the others are never requested
+    time.sleep(0.2)
+    assert server.request_count('appointments') <= 2
@@ -0,0 +1,356 @@
+# Local stand-in for the zermelo api, serving a synthetic school. Implements the endpoints the Zermelo client
+# uses, with configurable latency, error injection, a 403 horizon and expiring sessions, for offline tests and
+# load tests. Point the client at it with Zermelo(base_url=server.base_url).
+#
+#   PYTHONPATH=src python -m tests.zermelo_server --port 8080 --latency 0.2 --error-rate 0.05 --horizon-weeks 8
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from tests.synthetic import TIMEZONE, SyntheticSchool, response
+
+SCHOOL_IN_SCHOOL_YEAR = 1
+
+# Instance id the tests log in to, the stand-in serves any
+INSTANCE = 'school'
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+
+
+class ZermeloStandIn:
+
+    def __init__(self, school: SyntheticSchool = None, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 error_status=500, horizon_weeks=None, token_lifetime=30 * 24 * 60 * 60, seed=0):
+        self.school = school if school is not None else SyntheticSchool(seed)
+
+        # Seconds every response is delayed
+        self.latency = latency
+        # Fraction of the requests answered with error_status instead
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Amount of upcoming requests answered with error_status, on top of error_rate
+        self.fail_next = 0
+        # Seconds sent in the Retry-After header of the injected errors, if not None
+        self.retry_after = None
+        # Appointment ranges of more weeks are forbidden (403)
+        self.horizon_weeks = horizon_weeks
+        # Weeks (from the first monday of the school) whose appointments are forbidden (403)
+        self.forbidden_weeks = set()
+        # Extra seconds the appointments of a week are delayed, by week
+        self.week_latency = {}
+        self.token_lifetime = token_lifetime
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.codes = {}
+        self.tokens = {}
+
+        # Changed fields of appointments by id, see modify_appointment
+        self.changes = {}
+
+        # Amount of requests per (method, endpoint)
+        self.requests = {}
+
+        # Requests being handled, and the most at once
+        self.active = 0
+        self.max_active = 0
+
+        server = self
+
+        class Handler(_Handler):
+            stand_in = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{{instance_id}}/api/v{{api_version}}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def create_code(self, user):
+        # Link code to log in as the user with code_login
+        code = ''.join(self.rng.choice('0123456789') for _ in range(12))
+
+        with self.lock:
+            self.codes[code] = user
+
+        return code
+
+    def create_token(self, user):
+        token = secrets.token_hex(16)
+
+        with self.lock:
+            self.tokens[token] = (user, time.time() + self.token_lifetime)
+
+        return token
+
+    def modify_appointment(self, appointment_id, **fields):
+        # Changes fields of an appointment from now on, marking it modified now
+        with self.lock:
+            self.changes[appointment_id] = {**self.changes.get(appointment_id, {}), **fields,
+                                            'lastModified': int(time.time())}
+
+    def expire_tokens(self):
+        # Ends every session, the next requests get a 401
+        with self.lock:
+            self.tokens.clear()
+
+    def request_count(self, endpoint=None, method='GET'):
+        with self.lock:
+            if endpoint is None:
+                return sum(self.requests.values())
+            return self.requests.get((method, endpoint), 0)
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+            self.max_active = self.active
+
+    def token_user(self, token):
+        with self.lock:
+            user, expires = self.tokens.get(token, (None, 0))
+
+        if expires < time.time():
+            return None, None
+        return user, expires
+
+    def handle(self, method, endpoint, query, form):
+        # Returns (status, body) for a request on the api
+        with self.lock:
+            self.requests[(method, endpoint)] = self.requests.get((method, endpoint), 0) + 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+        try:
+            return self._handle(method, endpoint, query, form)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _handle(self, method, endpoint, query, form):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            fail = self.fail_next > 0
+            self.fail_next = max(0, self.fail_next - 1)
+
+        if fail or (self.error_rate and self.rng.random() < self.error_rate):
+            return self.error_status, {'response': {'status': self.error_status, 'message': 'Injected error'}}
+
+        if method == 'POST' and endpoint == 'oauth/token':
+            with self.lock:
+                user = self.codes.pop(form.get('code', ''), None)
+
+            if user is None:
+                return 400, {'response': {'status': 400, 'message': 'The request was syntactically incorrect.'}}
+            return 200, {'access_token': self.create_token(user), 'token_type': 'bearer'}
+
+        user, expires = self.token_user(query.get('access_token'))
+        if user is None:
+            return 401, {'response': {'status': 401, 'message': 'Unauthorized'}}
+
+        if method == 'POST' and endpoint == 'oauth/logout':
+            with self.lock:
+                self.tokens.pop(query.get('access_token'), None)
+            return 200, response([])
+
+        if method != 'GET':
+            return 404, {'response': {'status': 404, 'message': 'Not found'}}
+
+        if endpoint == 'tokens/~current':
+            return 200, response([{'user': user, 'expires': int(expires)}])
+
+        if endpoint == 'users/~me':
+            return 200, response([self.user(user)])
+
+        if endpoint == 'users':
+            if query.get('isStudent') == 'true':
+                users = [self.user(student) for student in self.school.students]
+            else:
+                users = [self.user(teacher) for teacher in self.school.teachers]
+            return 200, response(project(users, query.get('fields')))
+
+        if endpoint == 'schoolfunctionsettings':
+            return 200, response([{
+                'schoolInSchoolYear': SCHOOL_IN_SCHOOL_YEAR,
+                'studentCanViewProjectSchedules': True,
+                'studentCanViewProjectNames': True,
+                'studentCanViewRelatedTeacherSchedules': True,
+                'employeeCanViewProjectSchedules': True,
+                'employeeCanViewColleagueSchedules': True,
+                'employeeCanViewOwnSchedule': True,
+            }])
+
+        if endpoint == 'appointments':
+            return self.appointments(query)
+
+        return 404, {'response': {'status': 404, 'message': 'Not found'}}
+
+    def user(self, code):
+        is_student = code in self.school.students
+
+        return {
+            'code': code,
+            'firstName': f'First{code}' if is_student else '',
+            'prefix': 'van' if code.endswith('7') else None,
+            'lastName': f'Last{code}',
+            'isStudent': is_student,
+            'isEmployee': not is_student,
+            'schoolInSchoolYears': [SCHOOL_IN_SCHOOL_YEAR],
+        }
+
+    def appointments(self, query):
+        start = int(query.get('start', 0))
+        end = int(query.get('end', 0))
+        user = query.get('user')
+
+        first_week = (datetime.fromtimestamp(start, tz=TIMEZONE).date() - self.school.first_monday).days // 7
+        last_week = (datetime.fromtimestamp(end, tz=TIMEZONE).date() - self.school.first_monday).days // 7
+
+        # Started weeks, independent of the time zone of the client
+        weeks = -(-(end - start) // WEEK_SECONDS)
+
+        if self.horizon_weeks is not None and weeks > self.horizon_weeks:
+            return 403, {'response': {'status': 403, 'message': 'Forbidden'}}
+
+        if self.forbidden_weeks.intersection(range(first_week, last_week + 1)):
+            return 403, {'response': {'status': 403, 'message': 'Forbidden'}}
+
+        delay = max((self.week_latency.get(week, 0) for week in range(first_week, last_week + 1)), default=0)
+        if delay:
+            time.sleep(delay)
+
+        if user not in self.school.students and user not in self.school.teacher_hours:
+            return 200, response([])
+
+        # One week at a time, so a week always has the same appointments no matter the range it is requested in
+        appointments = [
+            {**appointment, **self.changes.get(appointment['id'], {})}
+            for week in range(first_week, last_week + 1)
+            for appointment in self.school.appointments(user, 1, week, valid_only=False)
+            if start <= appointment['start'] and appointment['end'] <= end
+        ]
+
+        # requests sends True, httpx sends true
+        if query.get('valid', '').lower() == 'true':
+            appointments = [a for a in appointments if a['valid']]
+        if query.get('cancelled', '').lower() == 'false':
+            appointments = [a for a in appointments if not a['cancelled']]
+        if 'modifiedSince' in query:
+            appointments = [a for a in appointments if a['lastModified'] >= int(query['modifiedSince'])]
+
+        return 200, response(project(appointments, query.get('fields')))
+
+
+def project(records, fields):
+    if not fields:
+        return records
+
+    fields = fields.split(',')
+    return [{field: record.get(field) for field in fields} for record in records]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    stand_in: ZermeloStandIn = None
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _endpoint(self, path):
+        # /{instance_id}/api/v3/{endpoint}
+        parts = path.strip('/').split('/', 3)
+        return parts[3] if len(parts) == 4 else ''
+
+    def _respond(self, method):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        form = {}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                form = json.loads(body or '{}')
+            else:
+                form = {key: values[-1] for key, values in parse_qs(body).items()}
+
+        status, data = self.stand_in.handle(method, self._endpoint(url.path), query, form)
+
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        if status >= 400 and self.stand_in.retry_after is not None:
+            self.send_header('Retry-After', str(self.stand_in.retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the zermelo api.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--horizon-weeks', type=int, help='forbid appointment ranges of more weeks (403)')
+    parser.add_argument('--classes', type=int, default=30)
+    parser.add_argument('--students-per-class', type=int, default=28)
+    parser.add_argument('--teachers', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    school = SyntheticSchool(args.seed, classes=args.classes, students_per_class=args.students_per_class,
+                             teachers=args.teachers)
+
+    server = ZermeloStandIn(school, args.host, args.port, args.latency, args.error_rate, args.error_status,
+                            args.horizon_weeks, seed=args.seed)
+
+    user = next(iter(school.students))
+    print(f"Base url: {server.base_url}")
+    print(f"Link code for {user}: {server.create_code(user)}")
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()